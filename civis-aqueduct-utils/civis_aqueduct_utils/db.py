@@ -0,0 +1,221 @@
+"""
+A shared connection to the ITA Postgres database for scheduled jobs.
+
+The engine is created the first time it is needed rather than when a job
+module is imported, and is shared by everything in the process. Its pool is
+sized for a few concurrent loaders, connections are checked before use and
+kept alive with TCP keepalives through long loads, and every statement is
+subject to a server-side timeout so that a stuck query fails the job rather
+than hanging it.
+
+It also provides a bulk upsert for SQLAlchemy tables, which COPYs rows into
+a temporary staging table and merges them into the target table with a single
+INSERT ... ON CONFLICT per chunk, rather than binding every row as a
+separate set of statement parameters. pyarrow is imported only by the
+upsert, so that jobs which only need a connection do not pay for it.
+"""
+import contextlib
+import io
+import os
+import threading
+from typing import TYPE_CHECKING, Optional, Sequence, Tuple, Union
+from urllib.parse import quote_plus
+
+import pandas
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+
+if TYPE_CHECKING:
+    import pyarrow
+
+POOL_SIZE = int(os.environ.get("POSTGRES_POOL_SIZE") or 5)
+MAX_OVERFLOW = int(os.environ.get("POSTGRES_MAX_OVERFLOW") or 5)
+
+# Recycle connections after this many seconds, before idle timeouts
+# on the server or in between can drop them.
+POOL_RECYCLE = 30 * 60
+
+# The maximum time a statement may run, in milliseconds.
+STATEMENT_TIMEOUT = int(os.environ.get("POSTGRES_STATEMENT_TIMEOUT") or 60 * 60 * 1000)
+
+CONNECT_ARGS = {
+    "connect_timeout": 30,
+    "keepalives": 1,
+    "keepalives_idle": 60,
+    "keepalives_interval": 10,
+    "keepalives_count": 5,
+    "options": f"-c statement_timeout={STATEMENT_TIMEOUT}",
+}
+
+# The number of rows to COPY and merge at a time in an upsert.
+UPSERT_CHUNKSIZE = 100_000
+
+_engine = None
+_lock = threading.Lock()
+
+
+def get_postgres_uri():
+    """
+    Get the URI of the Postgres database. In development this is taken from
+    POSTGRES_URI, and on Civis it is built from the injected credential.
+    """
+    if os.environ.get("DEV"):
+        return os.environ.get("POSTGRES_URI")
+    return (
+        f"postgres://"
+        f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_USERNAME'])}:"
+        f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_PASSWORD'])}@"
+        f"{os.environ['POSTGRES_HOST']}:{os.environ['POSTGRES_PORT']}"
+        f"/{os.environ['POSTGRES_DATABASE']}"
+    )
+
+
+def get_engine():
+    """
+    Get the shared engine for the Postgres database, creating it on first use.
+
+    Returns
+    -------
+    A sqlalchemy.engine.Engine.
+    """
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = sqlalchemy.create_engine(
+                get_postgres_uri(),
+                pool_size=POOL_SIZE,
+                max_overflow=MAX_OVERFLOW,
+                pool_recycle=POOL_RECYCLE,
+                pool_pre_ping=True,
+                connect_args=CONNECT_ARGS,
+            )
+    return _engine
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Run statements in a single transaction on a pooled connection, e.g.
+
+        with transaction() as conn:
+            conn.execute(...)
+
+    The transaction is committed if the block succeeds and rolled back
+    if it raises, and the connection is returned to the pool either way.
+    """
+    with get_engine().begin() as conn:
+        yield conn
+
+
+def get_conflict_columns(table: sqlalchemy.Table) -> Sequence[str]:
+    """
+    Get the columns identifying a row of a table for an upsert: its primary key,
+    or if it has none, the columns of its first unique constraint.
+    """
+    if len(table.primary_key):
+        return [c.name for c in table.primary_key]
+    for constraint in table.constraints:
+        if isinstance(constraint, sqlalchemy.UniqueConstraint):
+            return [c.name for c in constraint.columns]
+    raise ValueError(f"{table.name} has no primary key or unique constraint")
+
+
+def copy_chunk(conn, staging: str, chunk: "pyarrow.Table") -> None:
+    """
+    COPY an Arrow table into a staging table. Null values are written as
+    unquoted empty fields, which COPY reads as NULL, while empty strings
+    are quoted, so the two stay distinct.
+    """
+    import pyarrow.csv
+
+    buf = io.BytesIO()
+    pyarrow.csv.write_csv(chunk, buf, pyarrow.csv.WriteOptions(include_header=False))
+    buf.seek(0)
+    columns = ", ".join(f'"{c}"' for c in chunk.column_names)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f'COPY "{staging}" ({columns}) FROM STDIN WITH (FORMAT csv)', buf
+    )
+
+
+def upsert(
+    table: sqlalchemy.Table,
+    data: Union[pandas.DataFrame, "pyarrow.Table"],
+    update: bool = False,
+    conflict_columns: Optional[Sequence[str]] = None,
+    chunksize: int = UPSERT_CHUNKSIZE,
+    conn=None,
+) -> Tuple[int, int]:
+    """
+    Bulk load rows into a table, skipping or updating rows which already exist.
+
+    Each chunk of rows is COPYed into a temporary staging table shaped like
+    the target, then merged into it with INSERT ... ON CONFLICT, all within
+    one transaction.
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The target table, which must exist.
+    data: pandas.DataFrame or pyarrow.Table
+        The rows to load. Columns which are not in the table are ignored.
+    update: bool
+        Whether to update existing rows with the new values, rather than
+        skipping them. Rows with the same key must then not appear twice
+        in the same chunk.
+    conflict_columns: list of str, optional
+        The columns identifying a row. When updating, defaults to the primary
+        key of the table, or the columns of its first unique constraint. When
+        skipping, defaults to skipping rows which violate any constraint.
+    chunksize: int
+        The number of rows to COPY and merge at a time.
+    conn: sqlalchemy.engine.Connection, optional
+        A connection in an open transaction to load on. Defaults to
+        a new transaction on the shared engine.
+
+    Returns
+    -------
+    The number of rows inserted (or updated), and the number skipped.
+    """
+    if conn is None:
+        with transaction() as conn:
+            return upsert(table, data, update, conflict_columns, chunksize, conn)
+
+    import pyarrow
+
+    if isinstance(data, pandas.DataFrame):
+        data = pyarrow.Table.from_pandas(data, preserve_index=False)
+    columns = [c.name for c in table.columns if c.name in data.column_names]
+    data = data.select(columns)
+
+    # The staging table lives only as long as the transaction.
+    staging = sqlalchemy.Table(
+        f"{table.name}__staging",
+        sqlalchemy.MetaData(),
+        *[sqlalchemy.Column(c.name, c.type) for c in table.columns],
+    )
+    target = conn.dialect.identifier_preparer.format_table(table)
+    conn.execute(
+        f'CREATE TEMPORARY TABLE IF NOT EXISTS "{staging.name}" (LIKE {target}) '
+        "ON COMMIT DROP"
+    )
+
+    insert = sqlalchemy.dialects.postgresql.insert(table).from_select(
+        columns, sqlalchemy.select([staging.c[c] for c in columns])
+    )
+    if update:
+        conflict_columns = conflict_columns or get_conflict_columns(table)
+        insert = insert.on_conflict_do_update(
+            index_elements=conflict_columns,
+            set_={c: insert.excluded[c] for c in columns if c not in conflict_columns},
+        )
+    else:
+        insert = insert.on_conflict_do_nothing(index_elements=conflict_columns)
+
+    written = 0
+    for start in range(0, data.num_rows, chunksize):
+        chunk = data.slice(start, chunksize)
+        copy_chunk(conn, staging.name, chunk)
+        written += conn.execute(insert).rowcount
+        conn.execute(f'TRUNCATE "{staging.name}"')
+    return written, data.num_rows - written
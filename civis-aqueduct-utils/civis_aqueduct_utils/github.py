@@ -1,8 +1,9 @@
 import base64
-import os
+import hashlib
+import io
 
 import fsspec
-import requests
+from civis_aqueduct_utils.httpclient import get_session
 
 # Function to overwrite file in GitHub
 DEFAULT_COMMITTER = {
@@ -10,6 +11,90 @@ DEFAULT_COMMITTER = {
     "email": "ITAData@lacity.org",
 }
 
+# Recursive trees of the branches uploaded to, keyed by (repo, branch).
+TREE_CACHE = {}
+
+
+def walk_tree(token, repo, sha, prefix=""):
+    """
+    Get the blob SHAs of every path under a tree, listing one directory at a
+    time, for trees too large for the API to return recursively.
+
+    Parameters
+    ----------
+    token: str
+        GitHub personal access token.
+    repo: str
+        Repo name, such as 'CityofLosAngeles/covid19-indicators`
+    sha: str
+        The SHA of the tree.
+    prefix: str
+        The path of the tree in the repo, ending with a slash.
+
+    Returns
+    -------
+    A mapping of "paths" in the repo to their blob SHAs.
+    """
+    r = get_session().get(
+        f"https://api.github.com/repos/{repo}/git/trees/{sha}",
+        headers={"Authorization": f"token {token}"},
+    )
+    r.raise_for_status()
+    tree = r.json()
+    if tree["truncated"]:
+        raise RuntimeError(f"The tree of {repo}/{prefix} is too large to list")
+    paths = {}
+    for i in tree["tree"]:
+        if i["type"] == "blob":
+            paths[prefix + i["path"]] = i["sha"]
+        elif i["type"] == "tree":
+            paths.update(walk_tree(token, repo, i["sha"], f"{prefix}{i['path']}/"))
+    return paths
+
+
+def get_tree(token, repo, branch, cache=TREE_CACHE):
+    """
+    Get the recursive tree of a branch, reusing a cached copy if the
+    branch has not changed since it was fetched. If the tree is too large to
+    fetch in one request, it is walked a directory at a time.
+
+    Parameters
+    ----------
+    token: str
+        GitHub personal access token.
+    repo: str
+        Repo name, such as 'CityofLosAngeles/covid19-indicators`
+    branch: str
+        Branch name, such as 'master'
+    cache: dict
+        The cache of trees, which can be shared by a batch of uploads.
+
+    Returns
+    -------
+    A dict with the SHA of the tree, the ETag of the response,
+    and a mapping of "paths" in the repo to their blob SHAs.
+    """
+    entry = cache.get((repo, branch))
+    headers = {"Authorization": f"token {token}"}
+    if entry and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    r = get_session().get(
+        f"https://api.github.com/repos/{repo}/git/trees/{branch}",
+        params={"recursive": 1},
+        headers=headers,
+    )
+    r.raise_for_status()
+    if r.status_code == 304:
+        return entry
+    tree = r.json()
+    if tree["truncated"]:
+        paths = walk_tree(token, repo, tree["sha"])
+    else:
+        paths = {i["path"]: i["sha"] for i in tree["tree"] if i["type"] == "blob"}
+    entry = {"sha": tree["sha"], "etag": r.headers.get("ETag"), "paths": paths}
+    cache[(repo, branch)] = entry
+    return entry
+
 
 def upload_file_to_github(
     token,
@@ -19,6 +104,7 @@ def upload_file_to_github(
     local_file_path,
     commit_message,
     committer=DEFAULT_COMMITTER,
+    cache=TREE_CACHE,
 ):
     """
     Parameters
@@ -40,35 +126,213 @@ def upload_file_to_github(
     commiter: dict
         name and email associated with the committer.
         Defaults to ITA robot user, if another committer is not provided..
+    cache: dict
+        The cache of branch trees used to look up the previous version.
     """
 
     BASE = "https://api.github.com"
 
-    # Get the sha of the previous version.
-    # Operate on the dirname rather than the path itself so we
-    # don't run into file size limitations.
-    r = requests.get(
-        f"{BASE}/repos/{repo}/contents/{os.path.dirname(path)}",
-        params={"ref": branch},
-        headers={"Authorization": f"token {token}"},
-    )
-    r.raise_for_status()
-    item = next(i for i in r.json() if i["path"] == path)
-    sha = item["sha"]
+    # Get the sha of the previous version from the tree of the branch,
+    # rather than the contents API, so we don't run into file size
+    # or directory listing limitations.
+    tree = get_tree(token, repo, branch, cache)
+    sha = tree["paths"].get(path)
 
     # Upload the new version
     with fsspec.open(local_file_path, "rb") as f:
         contents = f.read()
 
-    r = requests.put(
+    body = {
+        "message": commit_message,
+        "committer": committer,
+        "branch": branch,
+        "content": base64.b64encode(contents).decode("utf-8"),
+    }
+    if sha:
+        body["sha"] = sha
+    r = get_session().put(
         f"{BASE}/repos/{repo}/contents/{path}",
         headers={"Authorization": f"token {token}"},
+        json=body,
+    )
+    r.raise_for_status()
+    tree["paths"][path] = r.json()["content"]["sha"]
+
+
+class Base64BlobBody:
+    """
+    A file-like request body for the GitHub create-blob API, which base64-encodes
+    a file into the JSON payload as it is read. The length of the payload is known
+    up front, so it can be streamed without holding the file in memory.
+    """
+
+    PREFIX = b'{"encoding": "base64", "content": "'
+    SUFFIX = b'"}'
+    CHUNKSIZE = 3 * 2 ** 18
+
+    def __init__(self, f, size):
+        self._f = f
+        self._length = len(self.PREFIX) + 4 * ((size + 2) // 3) + len(self.SUFFIX)
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=0):
+        """
+        Rewind the body to the start, so that the request can be retried.
+        """
+        if offset or whence:
+            raise io.UnsupportedOperation("Can only seek to the start of the body")
+        self._f.seek(0)
+        self._buffer = self.PREFIX
+        self._leftover = b""
+        self._done = False
+        return 0
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            chunk = self._f.read(self.CHUNKSIZE)
+            data = self._leftover + chunk
+            if chunk:
+                # Only encode whole 3-byte groups until the end of the file,
+                # so that padding is never inserted mid-stream.
+                cut = len(data) // 3 * 3
+                self._buffer += base64.b64encode(data[:cut])
+                self._leftover = data[cut:]
+            else:
+                self._buffer += base64.b64encode(data) + self.SUFFIX
+                self._done = True
+        if size < 0:
+            size = len(self._buffer)
+        out, self._buffer = self._buffer[:size], self._buffer[size:]
+        return out
+
+
+def file_size(f):
+    """
+    Get the size of an open file, leaving it positioned at the start.
+    """
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(0)
+    return size
+
+
+def git_blob_sha(local_file_path):
+    """
+    Compute the git blob SHA of a local or remote file, as GitHub would,
+    reading it in chunks.
+    """
+    with fsspec.open(local_file_path, "rb") as f:
+        sha = hashlib.sha1(f"blob {file_size(f)}\0".encode())
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def upload_files_to_github(
+    token,
+    repo,
+    branch,
+    files,
+    commit_message,
+    committer=DEFAULT_COMMITTER,
+    cache=TREE_CACHE,
+):
+    """
+    Upload many files to GitHub in a single commit using the Git Data API.
+
+    Files whose contents match those already on the branch are skipped,
+    and if no files have changed, no commit is made. Unlike
+    upload_file_to_github, this is not subject to the size limit
+    of the contents API.
+
+    Parameters
+    ----------
+    token: str
+        GitHub personal access token and corresponds to GITHUB_TOKEN
+        in Civis credentials.
+    repo: str
+        Repo name, such as 'CityofLosAngeles/covid19-indicators`
+    branch: str
+        Branch name, such as 'master'
+    files: dict
+        A mapping from paths within the repo to the paths of the local
+        files to be uploaded to them.
+    commit_message: str
+        Commit message used when making the git commit.
+    commiter: dict
+        name and email associated with the committer.
+        Defaults to ITA robot user, if another committer is not provided..
+    cache: dict
+        The cache of branch trees used to find unchanged files.
+
+    Returns
+    -------
+    The SHA of the new commit, or None if no files changed.
+    """
+    BASE = f"https://api.github.com/repos/{repo}/git"
+    headers = {"Authorization": f"token {token}"}
+
+    # Get the current commit and tree of the branch. The ref is read first,
+    # so if the branch moves in between, the tree is newer than the parent
+    # and updating the ref fails rather than reverting the other changes.
+    r = get_session().get(f"{BASE}/ref/heads/{branch}", headers=headers)
+    r.raise_for_status()
+    parent = r.json()["object"]["sha"]
+    base = get_tree(token, repo, branch, cache)
+    existing = base["paths"]
+
+    # Create blobs for the files that have changed.
+    tree = []
+    for path, local_file_path in files.items():
+        if existing.get(path) == git_blob_sha(local_file_path):
+            print(f"{path} is unchanged, skipping")
+            continue
+        with fsspec.open(local_file_path, "rb") as f:
+            r = get_session().post(
+                f"{BASE}/blobs",
+                headers={**headers, "Content-Type": "application/json"},
+                data=Base64BlobBody(f, file_size(f)),
+                retry=True,
+            )
+        r.raise_for_status()
+        tree.append(
+            {"path": path, "mode": "100644", "type": "blob", "sha": r.json()["sha"]}
+        )
+    if not tree:
+        print("No files have changed, not committing")
+        return None
+
+    # Make a commit with the new tree and point the branch at it. Blobs and
+    # trees are addressed by their contents, so creating them again is
+    # harmless and they are retried, unlike the commit.
+    r = get_session().post(
+        f"{BASE}/trees",
+        headers=headers,
+        json={"base_tree": base["sha"], "tree": tree},
+        retry=True,
+    )
+    r.raise_for_status()
+    new_tree = r.json()["sha"]
+    r = get_session().post(
+        f"{BASE}/commits",
+        headers=headers,
         json={
             "message": commit_message,
+            "tree": new_tree,
+            "parents": [parent],
+            "author": committer,
             "committer": committer,
-            "branch": branch,
-            "sha": sha,
-            "content": base64.b64encode(contents).decode("utf-8"),
         },
     )
     r.raise_for_status()
+    commit = r.json()["sha"]
+    r = get_session().patch(
+        f"{BASE}/refs/heads/{branch}", headers=headers, json={"sha": commit}
+    )
+    r.raise_for_status()
+    base["sha"] = new_tree
+    existing.update({i["path"]: i["sha"] for i in tree})
+    return commit
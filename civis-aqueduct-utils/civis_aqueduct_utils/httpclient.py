@@ -0,0 +1,232 @@
+"""
+A shared HTTP client for jobs which fetch from external APIs.
+
+Requests go through a pooled session, so connections to a host are kept
+alive and reused rather than paying for a new TLS handshake each time.
+Connection errors, timeouts, 429s and 5xx responses to idempotent requests
+are retried with jittered exponential backoff, honoring Retry-After, so that
+a transient blip doesn't fail a whole nightly job. Other requests, such as
+POSTs, are only retried when the caller says they are safe to send again.
+Requests to a host can be rate limited, and the latency of every request
+is recorded by host.
+"""
+
+import collections
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+# The number of times to retry a request, and the base and maximum delay
+# between attempts, in seconds.
+RETRIES = int(os.environ.get("HTTP_RETRIES") or 5)
+BACKOFF = float(os.environ.get("HTTP_BACKOFF") or 0.5)
+MAX_BACKOFF = 60
+
+# The connect and read timeouts of a request, in seconds.
+TIMEOUT = (10, 120)
+
+# The number of connections to keep open to each host.
+POOL_SIZE = 10
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The methods which can be retried by default, since sending them
+# twice has the same effect as sending them once.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+
+# The maximum requests per second to each host, e.g.
+# HTTP_RATE_LIMITS="api.github.com=10,track-api.syncromatics.com=5".
+RATE_LIMITS = {
+    host: float(rate)
+    for host, rate in (
+        limit.split("=")
+        for limit in (os.environ.get("HTTP_RATE_LIMITS") or "").split(",")
+        if limit
+    )
+}
+
+_session = None
+_pid = None
+_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Space out requests so that no more than `rate` start each second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+class Metrics:
+    """
+    The latencies of the requests made to each host, and how many
+    were retried or failed.
+    """
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.retries = collections.Counter()
+        self.failures = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, host: str, seconds: float, retry: bool, failed: bool):
+        with self._lock:
+            self.latencies[host].append(seconds)
+            self.retries[host] += retry
+            self.failures[host] += failed
+
+    def summary(self) -> str:
+        """
+        Summarize the requests to each host, e.g.
+        "api.github.com: 12 requests, 1 retried, 0 failed,
+        p50 0.210 s, p95 0.540 s, max 0.610 s".
+        """
+        lines = []
+        with self._lock:
+            for host, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                p50 = latencies[len(latencies) // 2]
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                lines.append(
+                    f"{host}: {len(latencies)} requests, "
+                    f"{self.retries[host]} retried, {self.failures[host]} failed, "
+                    f"p50 {p50:.3f} s, p95 {p95:.3f} s, max {latencies[-1]:.3f} s"
+                )
+        return "\n".join(lines)
+
+
+class Session(requests.Session):
+    """
+    A requests session with connection pooling, retries with backoff,
+    per-host rate limits and latency metrics.
+
+    Requests with idempotent methods are retried. Any other request is only
+    retried if it was never processed: after a 429, or a timeout connecting.
+    Pass retry=True to a request which is safe to send again, such as a
+    read-only POST, to retry it like an idempotent one, or retry=False
+    to never retry it.
+
+    Parameters
+    ----------
+    retries: int
+        The number of times to retry a request which fails with a connection
+        error, timeout, or a 429 or 5xx response.
+    backoff: float
+        The base delay between attempts, in seconds. The delay before each
+        retry is drawn uniformly from zero up to double the previous limit.
+    timeout: float or tuple
+        The default connect and read timeouts of a request, in seconds.
+    rate_limits: dict
+        The maximum requests per second to each host. Defaults to those set by
+        the HTTP_RATE_LIMITS environment variable.
+    pool_size: int
+        The number of connections to keep open to each host.
+    """
+
+    def __init__(
+        self,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        timeout=TIMEOUT,
+        rate_limits: Optional[Dict[str, float]] = None,
+        pool_size: int = POOL_SIZE,
+    ):
+        super().__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if rate_limits is None:
+            rate_limits = RATE_LIMITS
+        self.limiters = {host: RateLimiter(rate) for host, rate in rate_limits.items()}
+        self.metrics = Metrics()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        """
+        Get the time to wait before retrying a request, in seconds.
+        """
+        retry_after = response is not None and response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(MAX_BACKOFF, int(retry_after))
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, retry=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).hostname
+        body = kwargs.get("data")
+        idempotent = method.upper() in IDEMPOTENT_METHODS if retry is None else retry
+        retries = 0 if retry is False else self.retries
+        # A streamed body can only be sent again if it can be rewound.
+        if hasattr(body, "read") and not hasattr(body, "seek"):
+            retries = 0
+
+        for attempt in range(retries + 1):
+            if attempt and hasattr(body, "seek"):
+                body.seek(0)
+            if host in self.limiters:
+                self.limiters[host].wait()
+            start = time.perf_counter()
+            response, error = None, None
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if error is not None:
+                transient = True
+                unprocessed = isinstance(error, requests.ConnectTimeout)
+            else:
+                transient = response.status_code in RETRY_STATUSES
+                unprocessed = response.status_code == 429
+            retrying = transient and attempt < retries and (idempotent or unprocessed)
+            self.metrics.record(
+                host, time.perf_counter() - start, retrying, transient and not retrying
+            )
+            if not retrying:
+                break
+            reason = error or f"HTTP {response.status_code}"
+            delay = self.delay(attempt, response)
+            print(
+                f"Retrying {method} {host}{urlsplit(url).path} in {delay:.1f} s "
+                f"after {reason}"
+            )
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+
+def get_session() -> Session:
+    """
+    Get the session shared by everything in the process, creating it on
+    first use. A forked worker process gets its own, rather than sharing
+    the open connections of its parent.
+    """
+    global _session, _pid
+    with _lock:
+        if _session is None or _pid != os.getpid():
+            _session = Session()
+            _pid = os.getpid()
+    return _session
@@ -0,0 +1,104 @@
+"""
+Profile the startup cost of job scripts.
+
+Each script is imported, without running its __main__ block, in a fresh
+interpreter started with `python -X importtime`, and the timings it reports
+are summarized by top-level package, so that the cost of heavy dependencies
+is easy to see and to keep down, e.g.
+
+    civis-importtime civis/transportation/bikeshare/trips.py --top 10
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple
+
+# Matches a line of -X importtime output, e.g.
+# "import time:       512 |       1024 |   pandas.core"
+LINE_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+class Import(NamedTuple):
+    name: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse_importtime(output: str) -> List[Import]:
+    """
+    Parse the output of -X importtime into a list of imports.
+    """
+    imports = []
+    for line in output.splitlines():
+        match = LINE_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append(
+                Import(name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2)
+            )
+    return imports
+
+
+def profile(path: str) -> List[Import]:
+    """
+    Import a script in a fresh interpreter with -X importtime, returning the
+    imports it made. Sibling modules of the script are importable, as they are
+    when it is run. A failed import is reported, and the imports made up to the
+    failure are still returned.
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    module = os.path.splitext(filename)[0]
+    code = f"import sys; sys.path.insert(0, {directory!r}); import {module}"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    if result.returncode:
+        errors = [line for line in result.stderr.splitlines() if line.strip()]
+        print(f"Importing {path} failed: {errors[-1] if errors else 'unknown error'}")
+    return parse_importtime(result.stderr)
+
+
+def by_package(imports: List[Import]) -> Dict[str, int]:
+    """
+    Sum the self time of imports by top-level package, in microseconds.
+    """
+    totals = {}
+    for i in imports:
+        package = i.name.split(".")[0]
+        totals[package] = totals.get(package, 0) + i.self_us
+    return totals
+
+
+def report(path: str, top: int = 15) -> int:
+    """
+    Print the total import time of a script and its most expensive packages,
+    returning the total in microseconds.
+    """
+    imports = profile(path)
+    total = sum(i.cumulative_us for i in imports if i.depth == 0)
+    print(f"{path}: {total / 1e6:.3f} s")
+    packages = sorted(by_package(imports).items(), key=lambda p: p[1], reverse=True)
+    for package, us in packages[:top]:
+        print(f"  {package:<30} {us / 1e6:8.3f} s {100 * us / (total or 1):5.1f}%")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("paths", nargs="+", help="The job scripts to profile")
+    parser.add_argument(
+        "--top", type=int, default=15, help="The number of packages to show"
+    )
+    args = parser.parse_args()
+    for path in args.paths:
+        report(path, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,168 @@
 """
 Small utility for creating shareable links to Civis services.
 """
+
 import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+
+# The number of services to share or unshare concurrently in a batch.
+WORKERS = int(os.environ.get("CIVIS_SERVICE_WORKERS") or 8)
+
+# Where the list of services is cached, and for how many seconds,
+# so that repeated list calls do not wait on the API.
+CACHE_PATH = os.environ.get("CIVIS_SERVICE_CACHE") or os.path.expanduser(
+    "~/.cache/civis-aqueduct-utils/services.json"
+)
+CACHE_TTL = int(os.environ.get("CIVIS_SERVICE_CACHE_TTL") or 300)
+
+_client = None
+_lock = threading.Lock()
+
 
-import civis
+def get_client():
+    """
+    Get the API client, creating it on first use, so that the commands
+    in a batch share its connections.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            import civis
+
+            _client = civis.APIClient()
+    return _client
+
+
+def cache_key() -> str:
+    """
+    Identify the user whose services are cached, without storing their API key.
+    """
+    return hashlib.sha256(os.environ.get("CIVIS_API_KEY", "").encode()).hexdigest()
+
+
+def get_services(refresh: bool = False) -> List[dict]:
+    """
+    Get the ID and name of every service, from the local cache if it was
+    written by the same user less than CACHE_TTL seconds ago.
+    """
+    try:
+        with open(CACHE_PATH) as f:
+            cache = json.load(f)
+        if (
+            not refresh
+            and cache["key"] == cache_key()
+            and time.time() - cache["fetched"] < CACHE_TTL
+        ):
+            return cache["services"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    services = [
+        {"id": s["id"], "name": s["name"]} for s in get_client().services.list()
+    ]
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH, "w") as f:
+        json.dump({"key": cache_key(), "fetched": time.time(), "services": services}, f)
+    return services
+
+
+def share(service_id: int, names: List[str]) -> List[str]:
+    """
+    Create share links for a service, returning a message for each name.
+    """
+    import civis
+
+    client = get_client()
+    service = client.services.get(service_id)
+    messages = []
+    for name in names:
+        try:
+            response = client.services.post_tokens(service_id, name)
+            token = response["token"]
+            url = f"{service['current_url']}/civis-platform-auth?token={token}"
+            messages.append(
+                f"Share service id {service_id} with the following URL: {url}"
+            )
+        except civis.base.CivisAPIError as e:
+            if "Name has already been taken" in str(e):
+                messages.append(
+                    f"The share name {name} is already in use for service id "
+                    f"{service_id}. Please choose another"
+                )
+            else:
+                raise e
+    return messages
+
+
+def unshare(service_id: int, names: List[str]) -> List[str]:
+    """
+    Delete share links of a service by name, returning a message for each name.
+    """
+    client = get_client()
+    tokens = {t["name"]: t for t in client.services.list_tokens(service_id)}
+    messages = []
+    for name in names:
+        if name in tokens:
+            client.services.delete_tokens(service_id, tokens[name]["id"])
+            messages.append(
+                f"Successfully unshared {name} from service id {service_id}"
+            )
+        else:
+            messages.append(
+                f"Could not find share token with the name {name} "
+                f"for service id {service_id}"
+            )
+    return messages
+
+
+def run_batch(func, ids: List[int], names: List[str]) -> None:
+    """
+    Apply share or unshare to many services concurrently, printing the results
+    as they complete. Failures are reported once every service has been tried.
+    """
+    failures = 0
+    with ThreadPoolExecutor(WORKERS) as executor:
+        futures = {executor.submit(func, i, names): i for i in ids}
+        for future in as_completed(futures):
+            try:
+                for message in future.result():
+                    print(message)
+            except Exception as e:
+                print(f"Service id {futures[future]} failed: {e}")
+                failures += 1
+    if failures:
+        raise SystemExit(f"{failures} of {len(ids)} services failed")
 
 
 def list_services(args):
-    client = civis.APIClient()
-    services = client.services.list()
+    services = get_services(refresh=args.refresh)
     print("List of services:")
     for service in services:
         print(f"\tID: {service['id']}\tName: {service['name']}")
 
 
 def share_service(args):
-    client = civis.APIClient()
-    service = client.services.get(args.id)
-    try:
-        response = client.services.post_tokens(args.id, args.name)
-        url = f"{service['current_url']}/civis-platform-auth?token={response['token']}"
-        print(f"Share service id {args.id} with the following URL: {url}")
-    except civis.base.CivisAPIError as e:
-        if "Name has already been taken" in str(e):
-            print(
-                f"The share name {args.name} is already in use. "
-                "Please choose another"
-            )
-        else:
-            raise e
+    for message in share(args.id, [args.name]):
+        print(message)
 
 
 def unshare_service(args):
-    client = civis.APIClient()
-    tokens = client.services.list_tokens(args.id)
-    try:
-        token = next(t for t in tokens if t["name"] == args.name)
-        client.services.delete_tokens(args.id, token["id"])
-        print(f"Successfully unshared {args.name}")
-    except StopIteration:
-        print(f"Could not find share token with the name {args.name}")
+    for message in unshare(args.id, [args.name]):
+        print(message)
+
+
+def share_services(args):
+    run_batch(share, args.ids, args.names)
+
+
+def unshare_services(args):
+    run_batch(unshare, args.ids, args.names)
 
 
 def main():
@@ -47,6 +170,11 @@ def main():
     subparsers = parser.add_subparsers()
 
     list_parser = subparsers.add_parser("list")
+    list_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help=f"Fetch the services even if they were listed in the last {CACHE_TTL}s",
+    )
     list_parser.set_defaults(func=list_services)
 
     share_parser = subparsers.add_parser("share")
@@ -61,6 +189,24 @@ def main():
     )
     unshare_parser.set_defaults(func=unshare_service)
 
+    for command, func, verb in [
+        ("share-batch", share_services, "share"),
+        ("unshare-batch", unshare_services, "unshare"),
+    ]:
+        batch_parser = subparsers.add_parser(command)
+        batch_parser.add_argument(
+            "ids", type=int, nargs="+", help=f"The IDs of the services to {verb}"
+        )
+        batch_parser.add_argument(
+            "-n",
+            "--name",
+            dest="names",
+            action="append",
+            required=True,
+            help=f"A name of the share URLs to {verb}. May be given more than once",
+        )
+        batch_parser.set_defaults(func=func)
+
     args = parser.parse_args()
     args.func(args)
 
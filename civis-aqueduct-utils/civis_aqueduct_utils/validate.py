@@ -0,0 +1,161 @@
+"""
+Validate dataframes against SQLAlchemy table definitions before loading them.
+
+The rules for each column are derived from its SQLAlchemy type and constraints,
+and checked in vectorized passes over the whole column, so that a bad load
+fails with a summary of every offending column before any rows are sent
+to the database, rather than partway through a bulk insert.
+"""
+from typing import List
+
+import numpy
+import pandas
+import sqlalchemy
+
+# The range of values for each integer type.
+INTEGER_BOUNDS = {
+    sqlalchemy.SmallInteger: (-(2 ** 15), 2 ** 15 - 1),
+    sqlalchemy.BigInteger: (-(2 ** 63), 2 ** 63 - 1),
+    sqlalchemy.Integer: (-(2 ** 31), 2 ** 31 - 1),
+}
+
+# The number of offending rows to show for each problem.
+MAX_EXAMPLES = 5
+
+
+class ValidationError(ValueError):
+    """
+    Raised when a dataframe does not conform to a table definition.
+    """
+
+
+def describe(problem: str, mask) -> str:
+    """
+    Describe a problem affecting the rows of a column selected by a boolean mask,
+    with the index labels of the first few.
+    """
+    rows = mask[mask].index[:MAX_EXAMPLES].tolist()
+    more = ", ..." if mask.sum() > MAX_EXAMPLES else ""
+    return f"{mask.sum()} {problem} (rows {', '.join(map(str, rows))}{more})"
+
+
+def is_number(s: pandas.Series) -> bool:
+    """
+    Whether a series has a numeric, non-boolean dtype.
+    """
+    types = pandas.api.types
+    return types.is_numeric_dtype(s) and not types.is_bool_dtype(s)
+
+
+def check_integer(column: sqlalchemy.Column, s: pandas.Series) -> List[str]:
+    """
+    Check that a series holds whole numbers within the range of an integer column.
+    """
+    if not is_number(s):
+        return [f"dtype {s.dtype} is not numeric"]
+    problems = []
+    if pandas.api.types.is_float_dtype(s):
+        fractional = (s != numpy.floor(s)) & s.notna()
+        if fractional.any():
+            problems.append(describe("non-integer values", fractional))
+    low, high = next(
+        bounds
+        for kind, bounds in INTEGER_BOUNDS.items()
+        if isinstance(column.type, kind)
+    )
+    overflow = ((s < low) | (s > high)).fillna(False)
+    if overflow.any():
+        problems.append(describe(f"values outside [{low}, {high}]", overflow))
+    return problems
+
+
+def check_float(column: sqlalchemy.Column, s: pandas.Series) -> List[str]:
+    """
+    Check that a series is numeric.
+    """
+    if not is_number(s):
+        return [f"dtype {s.dtype} is not numeric"]
+    return []
+
+
+def check_string(column: sqlalchemy.Column, s: pandas.Series) -> List[str]:
+    """
+    Check that a series holds strings no longer than the length of the column.
+    """
+    if pandas.api.types.infer_dtype(s, skipna=True) not in ["string", "empty"]:
+        return [f"dtype {s.dtype} does not hold strings"]
+    length = column.type.length
+    if length is not None:
+        too_long = (s.str.len() > length).fillna(False)
+        if too_long.any():
+            return [describe(f"values longer than {length} characters", too_long)]
+    return []
+
+
+def check_datetime(column: sqlalchemy.Column, s: pandas.Series) -> List[str]:
+    """
+    Check that a series holds timestamps which are timezone-aware
+    if and only if the column is.
+    """
+    if not pandas.api.types.is_datetime64_any_dtype(s):
+        return [f"dtype {s.dtype} is not a datetime"]
+    aware = getattr(s.dtype, "tz", None) is not None
+    if column.type.timezone and not aware:
+        return ["timestamps are timezone-naive, but the column has a timezone"]
+    if not column.type.timezone and aware:
+        return [f"timestamps are in {s.dtype.tz}, but the column has no timezone"]
+    return []
+
+
+# The checks for each column type, in order of precedence.
+TYPE_CHECKS = [
+    (sqlalchemy.Integer, check_integer),
+    (sqlalchemy.Float, check_float),
+    (sqlalchemy.String, check_string),
+    (sqlalchemy.DateTime, check_datetime),
+]
+
+
+def validate(table: sqlalchemy.Table, df: pandas.DataFrame) -> None:
+    """
+    Verify that a dataframe can be loaded into a SQLAlchemy table.
+
+    Every column of the table must be in the dataframe, non-nullable columns
+    must have no nulls, integers must be whole and fit the column type,
+    strings must fit the column length, and timestamps must be
+    timezone-aware if and only if the column is.
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The table into which the dataframe will be loaded.
+    df: pandas.DataFrame
+        The dataframe to validate.
+
+    Raises
+    ------
+    ValidationError
+        If there are any problems, listing them by column.
+    """
+    problems = []
+    for column in table.columns:
+        if column.name not in df.columns:
+            problems.append(f"{column.name}: missing")
+            continue
+        s = df[column.name]
+        column_problems = []
+        if not column.nullable:
+            nulls = s.isna()
+            if nulls.any():
+                column_problems.append(describe("nulls in a NOT NULL column", nulls))
+        for kind, check in TYPE_CHECKS:
+            if isinstance(column.type, kind):
+                column_problems += check(column, s)
+                break
+        problems += [f"{column.name}: {p}" for p in column_problems]
+
+    if problems:
+        raise ValidationError(
+            f"{len(df)} rows do not conform to {table.name}:\n  "
+            + "\n  ".join(problems)
+        )
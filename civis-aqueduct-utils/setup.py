@@ -6,7 +6,16 @@ setup(
     packages=find_packages(),
     package_dir={"civis-aqueduct-utils": "civis-aqueduct-utils"},
     include_package_data=True,
-    install_requires=["civis"],
+    install_requires=[
+        "civis",
+        "fsspec",
+        "numpy",
+        "pandas",
+        "psycopg2",
+        "pyarrow",
+        "requests",
+        "sqlalchemy<2",
+    ],
     data_files=[
         (
             "share/jupyter/nbextensions/civis-aqueduct-utils",
@@ -14,6 +23,9 @@ setup(
         ),
     ],
     entry_points={
-        "console_scripts": ["civis-service = civis_aqueduct_utils.share:main"]
+        "console_scripts": [
+            "civis-service = civis_aqueduct_utils.share:main",
+            "civis-importtime = civis_aqueduct_utils.importtime:main",
+        ]
     },
 )
@@ -1,40 +1,283 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from arcgis import GIS
 import os
-import intake_civis
-import ibis
-from arcgis.features import FeatureLayerCollection
-
-# Prepping credentials
-lahub_user = os.environ["LAHUB_ACC_USERNAME"]
-lahub_pass = os.environ["LAHUB_ACC_PASSWORD"]
+import pandas as pd
 
 pwd = os.getcwd()
 OUTPUT_FILE = pwd + "/MyLA311 Service Requests Last 6 Months.csv"
 myla311_layer = "4db3e9c3d13543b6a686098e0603ddcf"
 
+# Number of rows to fetch from Redshift and write to the CSV at a time
+CHUNKSIZE = 100_000
+
+# The previous snapshot of the layer, used to compute the edits for the next
+# run. This is kept on S3 by default, since the container does not keep
+# files between runs, but may be overridden with a local path in development.
+SNAPSHOT_PATH = (
+    os.environ.get("SNAPSHOT_PATH") or "s3://tmf-ita-data/kyc/myla311_snapshot.parquet"
+)
+
+# The service request number uniquely identifies each feature in the layer
+KEY = "srnumber"
+LATITUDE = "latitude"
+LONGITUDE = "longitude"
+DATE_COLUMNS = ["createddate", "updateddate", "servicedate", "closeddate"]
+
+# Number of features to send in a single edit_features call
+EDIT_BATCH_SIZE = 1000
+
+# Layer fields maintained by ArcGIS rather than published from the extract
+SYSTEM_FIELD_TYPES = {
+    "esriFieldTypeOID",
+    "esriFieldTypeGlobalID",
+    "esriFieldTypeGeometry",
+}
+
+
+def date_columns(columns):
+    return [c for c in DATE_COLUMNS if c in columns]
+
+
+def get_layer_columns(user, pw, layer):
+    """
+    Get the names of the fields published to the layer, so that the extract
+    keeps the schema of the layer.
+    """
+    from arcgis import GIS
+
+    geohub = GIS("https://lahub.maps.arcgis.com", user, pw)
+    flayer = geohub.content.get(layer).layers[0]
+    return [
+        f["name"]
+        for f in flayer.properties.fields
+        if f["type"] not in SYSTEM_FIELD_TYPES
+    ]
+
+
+def check_columns(fields, columns):
+    """
+    Check that every field of the layer is a column of public.import311,
+    and that the layer has the key and coordinate fields.
+    """
+    missing = [f for f in fields if f not in columns]
+    if missing:
+        raise ValueError(f"The layer has fields not in import311: {missing}")
+    required = [c for c in [KEY, LATITUDE, LONGITUDE] if c not in fields]
+    if required:
+        raise ValueError(f"The layer is missing the required fields {required}")
+
 
 # For 311
-def prep_311_data(file):
+def prep_311_data(file, fields):
+    import ibis
+    import intake_civis
+    from intake_civis.alchemy import get_redshift_engine
+
     catalog = intake_civis.open_redshift_catalog()
     expr = catalog.public.import311.to_ibis()
+    check_columns(fields, expr.columns)
     recent_srs = expr[
         (expr.createddate > (ibis.now() - ibis.interval(months=6)))
         & (expr.requesttype != "Homeless Encampment")
-    ]
-    df = recent_srs.execute()
-    df.to_csv(file, index=False)
+    ][fields]
+    # Stream the results through a server-side cursor and append them
+    # to the CSV a chunk at a time, rather than loading six months at once.
+    engine = get_redshift_engine()
+    with engine.connect() as conn, open(file, "w", newline="") as f:
+        conn = conn.execution_options(stream_results=True)
+        chunks = pd.read_sql(recent_srs.compile(), conn, chunksize=CHUNKSIZE)
+        header = True
+        for df in chunks:
+            df.to_csv(f, index=False, header=header)
+            header = False
+        # Write the header of an empty extract, so that it can still be read.
+        if header:
+            pd.DataFrame(columns=fields).to_csv(f, index=False)
 
 
 def update_geohub_layer(user, pw, layer, update_data):
+    from arcgis import GIS
+    from arcgis.features import FeatureLayerCollection
+
     geohub = GIS("https://lahub.maps.arcgis.com", user, pw)
     flayer = geohub.content.get(layer)
     flayer_collection = FeatureLayerCollection.fromitem(flayer)
     flayer_collection.manager.overwrite(update_data)
 
 
+def hash_rows(file):
+    """
+    Hash every row of the extract, returning a series of row hashes
+    indexed by service request number.
+    """
+    hashes = []
+    for df in pd.read_csv(file, dtype=str, chunksize=CHUNKSIZE):
+        hashes.append(
+            pd.Series(
+                pd.util.hash_pandas_object(df, index=False).to_numpy(),
+                index=df[KEY],
+                name="hash",
+            )
+        )
+    if not hashes:
+        return pd.Series([], index=pd.Index([], name=KEY), name="hash", dtype="uint64")
+    hashes = pd.concat(hashes)
+    return hashes[~hashes.index.duplicated(keep="last")]
+
+
+def read_rows(file, keys):
+    """
+    Read the rows of the extract for a set of service request numbers.
+    """
+    columns = pd.read_csv(file, nrows=0).columns
+    chunks = [
+        df[df[KEY].isin(keys)]
+        for df in pd.read_csv(
+            file,
+            dtype={KEY: str},
+            parse_dates=date_columns(columns),
+            chunksize=CHUNKSIZE,
+        )
+    ]
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks)
+
+
+def to_features(df, object_ids=None):
+    """
+    Convert rows of the extract to ArcGIS point features, with dates as epoch
+    milliseconds. If object_ids is given, include each feature's object ID
+    so the features can be used as updates.
+    """
+    df = df.copy()
+    for col in date_columns(df.columns):
+        df[col] = (df[col] - pd.Timestamp("1970-01-01")) // pd.Timedelta(milliseconds=1)
+    df = df.astype(object).where(df.notna(), None)
+    features = []
+    for row in df.to_dict(orient="records"):
+        if object_ids is not None:
+            oid_field, oids = object_ids
+            row[oid_field] = oids[row[KEY]]
+        feature = {"attributes": row}
+        if row[LATITUDE] is not None and row[LONGITUDE] is not None:
+            feature["geometry"] = {
+                "x": row[LONGITUDE],
+                "y": row[LATITUDE],
+                "spatialReference": {"wkid": 4326},
+            }
+        features.append(feature)
+    return features
+
+
+def get_object_ids(flayer):
+    """
+    Look up the object IDs of every feature in the layer by service request
+    number. Returns the object ID field name, a dict mapping keys to object IDs,
+    and the object IDs of any further features with an already seen key.
+    """
+    oid_field = flayer.properties.objectIdField
+    oids = {}
+    duplicates = []
+    result = flayer.query(
+        where="1=1", out_fields=f"{oid_field},{KEY}", return_geometry=False
+    )
+    for f in result.features:
+        key, oid = f.attributes[KEY], f.attributes[oid_field]
+        if key in oids:
+            duplicates.append(oid)
+        else:
+            oids[key] = oid
+    return oid_field, oids, duplicates
+
+
+def apply_edits(flayer, adds=(), updates=(), deletes=()):
+    """
+    Apply feature edits to a layer in batches, raising if any edit fails.
+    """
+    failures = []
+    for kind, edits in [("adds", adds), ("updates", updates), ("deletes", deletes)]:
+        edits = list(edits)
+        for i in range(0, len(edits), EDIT_BATCH_SIZE):
+            batch = edits[i : i + EDIT_BATCH_SIZE]
+            if kind == "deletes":
+                batch = ",".join(str(oid) for oid in batch)
+            result = flayer.edit_features(**{kind: batch})
+            for results in result.values():
+                failures.extend(r for r in results if not r.get("success"))
+    if failures:
+        raise RuntimeError(f"{len(failures)} edits failed, e.g. {failures[0]}")
+
+
+def update_geohub_layer_delta(user, pw, layer, update_data, snapshot):
+    """
+    Update the layer with only the features that were added, changed,
+    or removed since the previous snapshot.
+
+    The snapshot is only used to find changed rows. Whether each row is added
+    or updated, and which features are deleted, is decided by the keys which
+    are actually in the layer, so that a run which failed partway through
+    is repaired by the next one rather than adding duplicate features.
+    """
+    from arcgis import GIS
+
+    geohub = GIS("https://lahub.maps.arcgis.com", user, pw)
+    flayer = geohub.content.get(layer).layers[0]
+
+    new = hash_rows(update_data)
+    old = snapshot["hash"]
+    common = new.index.intersection(old.index)
+    changed = new.index.difference(old.index).union(
+        common[new[common].to_numpy() != old[common].to_numpy()]
+    )
+
+    oid_field, oids, duplicates = get_object_ids(flayer)
+    present = pd.Index(list(oids), dtype=object)
+    added = new.index.difference(present)
+    updated = changed.intersection(present)
+    deleted = present.difference(new.index)
+    print(
+        f"{len(added)} adds, {len(updated)} updates, "
+        f"{len(deleted) + len(duplicates)} deletes"
+    )
+
+    rows = read_rows(update_data, added.union(updated))
+    apply_edits(
+        flayer,
+        adds=to_features(rows[rows[KEY].isin(added)]),
+        updates=to_features(rows[rows[KEY].isin(updated)], (oid_field, oids)),
+        deletes=[oids[k] for k in deleted] + duplicates,
+    )
+    return new
+
+
+def load_snapshot(path):
+    """
+    Load the row hashes from the previous run, if there was one.
+    """
+    try:
+        return pd.read_parquet(path)
+    except FileNotFoundError:
+        return None
+
+
 if __name__ == "__main__":
-    prep_311_data(OUTPUT_FILE)
-    update_geohub_layer(lahub_user, lahub_pass, myla311_layer, OUTPUT_FILE)
+    # Prepping credentials
+    lahub_user = os.environ["LAHUB_ACC_USERNAME"]
+    lahub_pass = os.environ["LAHUB_ACC_PASSWORD"]
+
+    # Publish exactly the fields the layer already has, since overwriting
+    # the layer expects its existing schema.
+    fields = get_layer_columns(lahub_user, lahub_pass, myla311_layer)
+    prep_311_data(OUTPUT_FILE, fields)
+    snapshot = load_snapshot(SNAPSHOT_PATH)
+    if snapshot is None or os.environ.get("FULL_OVERWRITE"):
+        update_geohub_layer(lahub_user, lahub_pass, myla311_layer, OUTPUT_FILE)
+        hashes = hash_rows(OUTPUT_FILE)
+    else:
+        hashes = update_geohub_layer_delta(
+            lahub_user, lahub_pass, myla311_layer, OUTPUT_FILE, snapshot
+        )
+    # Only record the snapshot once the layer is up to date
+    hashes.to_frame().to_parquet(SNAPSHOT_PATH)
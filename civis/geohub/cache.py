@@ -0,0 +1,153 @@
+"""
+A local, content-addressed cache for downloaded geohub source archives.
+
+Downloads are stored under their SHA-256 digest, and an index maps each URL
+to its digest along with the ETag and Last-Modified headers of the response.
+Cached URLs are revalidated with a conditional request, so an unchanged
+archive is read from disk rather than downloaded again. When the cache grows
+past its maximum size, the least recently used archives are evicted.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Dict, Iterator
+from urllib.parse import urlparse
+
+import intake
+from civis_aqueduct_utils.httpclient import get_session
+
+CACHE_DIR = os.environ.get("GEOHUB_CACHE_DIR") or os.path.expanduser("~/.cache/geohub")
+CACHE_SIZE = int(os.environ.get("GEOHUB_CACHE_SIZE") or 10 * 2 ** 30)
+
+# Matches a remote URL within an intake urlpath, which may be chained
+# with other fsspec protocols, e.g. "zip://*.shp::https://...".
+URL_PATTERN = re.compile(r"https?://.+?(?=::|$)")
+
+
+@contextlib.contextmanager
+def locked_index(cache_dir: str = CACHE_DIR) -> Iterator[Dict[str, dict]]:
+    """
+    Open the cache index for modification, holding a lock so that
+    concurrent loaders don't clobber each other's entries.
+    """
+    os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+    path = os.path.join(cache_dir, "index.json")
+    with open(os.path.join(cache_dir, "index.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                index = json.load(f)
+        yield index
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(f"{path}.tmp", path)
+
+
+def blob_path(entry: dict, cache_dir: str = CACHE_DIR) -> str:
+    """
+    Get the local path of a cached archive from its index entry.
+    """
+    return os.path.join(cache_dir, "blobs", entry["digest"] + entry["suffix"])
+
+
+def evict(
+    index: Dict[str, dict], max_size: int, keep: str, cache_dir: str = CACHE_DIR
+) -> None:
+    """
+    Evict the least recently used archives from the cache until it is no
+    larger than max_size bytes, never evicting the archive at path keep.
+    """
+    blobs = {}
+    for entry in sorted(index.values(), key=lambda e: e["accessed"], reverse=True):
+        blobs.setdefault(blob_path(entry, cache_dir), entry)
+    total = sum(e["size"] for e in blobs.values())
+    for path, entry in reversed(list(blobs.items())):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        for url in [u for u, e in index.items() if blob_path(e, cache_dir) == path]:
+            del index[url]
+        if os.path.exists(path):
+            os.remove(path)
+        total -= entry["size"]
+
+
+def fetch(url: str, cache_dir: str = CACHE_DIR, max_size: int = CACHE_SIZE) -> str:
+    """
+    Get a local copy of a remote file, downloading it only if it is not
+    cached or has changed since it was cached.
+
+    Parameters
+    ==========
+    url: str
+        The URL of the file.
+    cache_dir: str
+        The cache directory.
+    max_size: int
+        The maximum size of the cache, in bytes.
+
+    Returns
+    =======
+    The local path of the file.
+    """
+    with locked_index(cache_dir) as index:
+        entry = index.get(url)
+    if entry and not os.path.exists(blob_path(entry, cache_dir)):
+        entry = None
+
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    with get_session().get(url, headers=headers, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        if r.status_code == 304:
+            print(f"Using cached {url}", flush=True)
+        else:
+            digest = hashlib.sha256()
+            size = 0
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                for chunk in r.iter_content(chunk_size=2 ** 20):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            entry = {
+                "digest": digest.hexdigest(),
+                "suffix": os.path.splitext(urlparse(url).path)[1],
+                "size": size,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+            }
+            os.replace(tmp, blob_path(entry, cache_dir))
+
+    path = blob_path(entry, cache_dir)
+    with locked_index(cache_dir) as index:
+        entry["accessed"] = time.time()
+        index[url] = entry
+        evict(index, max_size, path, cache_dir)
+    return path
+
+
+def localize(source: intake.Source, cache_dir: str = CACHE_DIR) -> intake.Source:
+    """
+    Point an intake source at cached local copies of its remote files,
+    downloading them into the cache if necessary.
+
+    Sources without a remote urlpath are returned unchanged.
+    """
+    urlpath = getattr(source, "urlpath", None)
+    if isinstance(urlpath, str):
+        source.urlpath = URL_PATTERN.sub(
+            lambda m: fetch(m.group(0), cache_dir), urlpath
+        )
+    return source
@@ -1,17 +1,239 @@
+import hashlib
+import multiprocessing
 import os
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import geopandas
 import intake
+import numpy
+import pandas
+import shapely
 import sqlalchemy
-from intake_civis.alchemy import get_postgres_engine
+from cache import localize
+from civis_aqueduct_utils import db
+from postgis import CHUNKSIZE, write_postgis, write_postgis_arrow
 
-if os.environ.get("DEV"):
-    engine = sqlalchemy.create_engine(os.environ.get("POSTGRES_URI"))
-else:
-    engine = get_postgres_engine()
+try:
+    from pyogrio.raw import open_arrow
+except ImportError:
+    open_arrow = None
 
+# The number of processes used to download and decode sources,
+# and the number of connections used to write them to PostGIS.
+READ_WORKERS = int(os.environ.get("READ_WORKERS") or 4)
+WRITE_WORKERS = int(os.environ.get("WRITE_WORKERS") or 2)
 
-def load_dataset(name: str, source: intake.Source, schema: str = "geohub") -> None:
+# The intake plugins for file sources that can be streamed with pyogrio
+# rather than read into memory in full.
+STREAMABLE_PLUGINS = {"shapefile", "geojson"}
+
+# The table recording the DCAT modified time and content hash of each
+# loaded dataset, so unchanged datasets can be skipped.
+STATE_TABLE = "load_state"
+
+_engine = None
+_lock = threading.Lock()
+
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """
+    Get the engine for the PostGIS database, creating it on first use rather
+    than on import, so that the read worker processes, which import this module
+    but never write, do not each create one. In development this is the shared
+    engine for POSTGRES_URI.
+    """
+    if os.environ.get("DEV"):
+        return db.get_engine()
+    global _engine
+    with _lock:
+        if _engine is None:
+            from intake_civis.alchemy import get_postgres_engine
+
+            _engine = get_postgres_engine()
+    return _engine
+
+
+def get_state_table(schema: str = "geohub") -> sqlalchemy.Table:
+    """
+    Define the load state table for a schema.
+    """
+    return sqlalchemy.Table(
+        STATE_TABLE,
+        sqlalchemy.MetaData(schema=schema),
+        sqlalchemy.Column("table_name", sqlalchemy.String, primary_key=True),
+        sqlalchemy.Column("modified", sqlalchemy.String),
+        sqlalchemy.Column("content_hash", sqlalchemy.String),
+        sqlalchemy.Column("loaded_at", sqlalchemy.DateTime(timezone=True)),
+    )
+
+
+def get_load_state(schema: str = "geohub") -> Dict[str, dict]:
+    """
+    Get the recorded load state of every dataset in a schema,
+    keyed by table name.
+    """
+    table = get_state_table(schema)
+    with get_engine().connect() as conn:
+        return {row.table_name: dict(row) for row in conn.execute(table.select())}
+
+
+def record_load_state(
+    name: str, modified: Optional[str], content_hash: str, schema: str = "geohub"
+) -> None:
+    """
+    Record the DCAT modified time and content hash of a loaded dataset.
+    """
+    table = get_state_table(schema)
+    values = {
+        "modified": modified,
+        "content_hash": content_hash,
+        "loaded_at": sqlalchemy.func.now(),
+    }
+    insert = sqlalchemy.dialects.postgresql.insert(table).values(
+        table_name=name, **values
+    )
+    with get_engine().begin() as conn:
+        conn.execute(
+            insert.on_conflict_do_update(index_elements=["table_name"], set_=values)
+        )
+
+
+def get_modified(entry) -> Optional[str]:
+    """
+    Get the DCAT modified time of a catalog entry, if it has one.
+    """
+    return (entry.describe().get("metadata") or {}).get("modified")
+
+
+def hash_dataset(df: pandas.DataFrame) -> str:
+    """
+    Compute a hash of the contents of a dataframe or geodataframe.
+    """
+    if isinstance(df, geopandas.GeoDataFrame):
+        df = pandas.DataFrame(df).assign(
+            **{df.geometry.name: df.geometry.to_wkb(hex=True)}
+        )
+    digest = hashlib.sha256(",".join(map(str, df.columns)).encode())
+    digest.update(pandas.util.hash_pandas_object(df, index=False).to_numpy())
+    return digest.hexdigest()
+
+
+def read_dataset(source: intake.Source) -> pandas.DataFrame:
+    """
+    Download and decode an intake source. Remote files are read through
+    the local download cache.
+
+    Parameters
+    ==========
+    source: intake.Source
+        The intake source.
+    """
+    return localize(source).read()
+
+
+def simplify_geometries(
+    geoms: numpy.ndarray,
+    tolerance: Optional[float] = None,
+    grid_size: Optional[float] = None,
+) -> numpy.ndarray:
+    """
+    Simplify an array of geometries and reduce their precision.
+
+    Parameters
+    ==========
+    geoms: numpy.ndarray
+        The geometries to simplify.
+    tolerance: float, optional
+        The tolerance for topology-preserving simplification,
+        in the units of the coordinate reference system.
+    grid_size: float, optional
+        The size of the grid to which coordinates are snapped,
+        in the units of the coordinate reference system.
+
+    Returns
+    =======
+    An array of the processed geometries.
+    """
+    if tolerance:
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    if grid_size:
+        geoms = shapely.set_precision(geoms, grid_size)
+    return geoms
+
+
+def simplify_dataset(
+    df: geopandas.GeoDataFrame,
+    tolerance: Optional[float] = None,
+    grid_size: Optional[float] = None,
+) -> geopandas.GeoDataFrame:
+    """
+    Simplify the geometries of a geodataframe and reduce their precision
+    (see simplify_geometries).
+
+    Returns
+    =======
+    A copy of the geodataframe with the processed geometries.
+    """
+    geoms = simplify_geometries(
+        numpy.asarray(df.geometry, dtype=object), tolerance, grid_size
+    )
+    return df.set_geometry(
+        geopandas.GeoSeries(geoms, index=df.index, crs=df.crs, name=df.geometry.name)
+    )
+
+
+def write_dataset(
+    name: str,
+    df: pandas.DataFrame,
+    schema: str = "geohub",
+    simplify: Optional[dict] = None,
+) -> None:
+    """
+    Write a dataframe to postgis, replacing any existing table.
+
+    Parameters
+    ==========
+    name: str
+        The name of the target table.
+    df: pandas.DataFrame
+        The dataframe or geodataframe to write.
+    schema: str
+        The schema into which to load the dataset.
+    simplify: dict, optional
+        Geometry simplification settings for the table, with optional keys
+        "tolerance" and "grid_size" (see simplify_dataset). If "table" is
+        given, the simplified geometries are written to a companion table
+        of that name, and the full ones to the target table. Otherwise the
+        simplified geometries replace the full ones.
+    """
+    if isinstance(df, geopandas.GeoDataFrame):
+        if simplify:
+            simplified = simplify_dataset(
+                df, simplify.get("tolerance"), simplify.get("grid_size")
+            )
+            if simplify.get("table"):
+                write_postgis(simplify["table"], simplified, get_engine(), schema)
+            else:
+                df = simplified
+        write_postgis(name, df, get_engine(), schema)
+    else:
+        df.to_sql(name, get_engine(), schema=schema, if_exists="replace")
+
+
+def load_dataset(
+    name: str,
+    source: intake.Source,
+    schema: str = "geohub",
+    simplify: Optional[dict] = None,
+) -> None:
     """
     Load an intake source into postgis.
 
@@ -23,12 +245,233 @@ def load_dataset(name: str, source: intake.Source, schema: str = "geohub") -> No
         The intake source.
     schema: str
         The schema into which to load the dataset.
+    simplify: dict, optional
+        Geometry simplification settings for the table (see write_dataset).
     """
-    df = source.read()
-    if isinstance(df, geopandas.GeoDataFrame):
-        df.to_postgis(name, engine, schema=schema, if_exists="replace")
-    else:
-        df.to_sql(name, engine, schema=schema, if_exists="replace")
+    write_dataset(name, read_dataset(source), schema, simplify)
+
+
+def read_and_hash_dataset(source: intake.Source) -> Tuple[pandas.DataFrame, str]:
+    """
+    Download and decode an intake source, and hash its contents.
+    """
+    df = read_dataset(source)
+    return df, hash_dataset(df)
+
+
+def write_changed_dataset(
+    name: str,
+    df: pandas.DataFrame,
+    content_hash: str,
+    modified: Optional[str],
+    schema: str = "geohub",
+    state: Optional[Dict[str, dict]] = None,
+    simplify: Optional[dict] = None,
+) -> bool:
+    """
+    Write a dataset to postgis unless its contents match those of the
+    last load, and record its load state.
+
+    Returns
+    =======
+    Whether the dataset was written.
+    """
+    previous = (state or {}).get(name, {})
+    changed = previous.get("content_hash") != content_hash
+    if changed:
+        write_dataset(name, df, schema, simplify)
+    record_load_state(name, modified, content_hash, schema)
+    return changed
+
+
+def can_stream(source: intake.Source) -> bool:
+    """
+    Whether a source is a geospatial file that can be streamed with pyogrio.
+    The source's instance name is its catalog entry, so the plugin name is
+    looked up on its class.
+    """
+    return open_arrow is not None and type(source).name in STREAMABLE_PLUGINS
+
+
+def stream_dataset(
+    name: str,
+    source: intake.Source,
+    modified: Optional[str],
+    schema: str = "geohub",
+    state: Optional[Dict[str, dict]] = None,
+    simplify: Optional[dict] = None,
+) -> bool:
+    """
+    Stream a geospatial file source into postgis as Arrow record batches,
+    without decoding it into a geodataframe, and record its load state.
+
+    The content hash of a streamed dataset is the digest of its downloaded
+    file in the local cache, so an unchanged file is not read at all.
+
+    Parameters
+    ==========
+    name: str
+        The name of the target table.
+    source: intake.Source
+        The intake source, with a shapefile or GeoJSON urlpath.
+    modified: str, optional
+        The DCAT modified time of the dataset.
+    schema: str
+        The schema into which to load the dataset.
+    state: dict, optional
+        The recorded load state, as returned by get_load_state.
+    simplify: dict, optional
+        Geometry simplification settings for the table (see write_dataset).
+
+    Returns
+    =======
+    Whether the dataset was written.
+    """
+    # The local file is the last link of a possibly chained urlpath,
+    # e.g. "zip://*.shp::/path/to/archive.zip".
+    path = localize(source).urlpath.split("::")[-1]
+    content_hash = os.path.splitext(os.path.basename(path))[0]
+    if (state or {}).get(name, {}).get("content_hash") == content_hash:
+        record_load_state(name, modified, content_hash, schema)
+        return False
+
+    tables = {name: None}
+    if simplify:
+
+        def transform(geoms):
+            return simplify_geometries(
+                geoms, simplify.get("tolerance"), simplify.get("grid_size")
+            )
+
+        tables[simplify.get("table") or name] = transform
+
+    with open_arrow(path, batch_size=CHUNKSIZE, use_pyarrow=True) as (meta, reader):
+        write_postgis_arrow(tables, reader, meta, get_engine(), schema)
+    record_load_state(name, modified, content_hash, schema)
+    return True
+
+
+def load_datasets(
+    sources: Iterable[Tuple[str, intake.Source, Optional[str]]],
+    schema: str = "geohub",
+    state: Optional[Dict[str, dict]] = None,
+    simplify: Optional[Dict[str, dict]] = None,
+    read_workers: int = READ_WORKERS,
+    write_workers: int = WRITE_WORKERS,
+) -> List[Tuple[str, Exception]]:
+    """
+    Load many intake sources into postgis concurrently.
+
+    Sources are downloaded and decoded in a pool of processes, and each one
+    is written to postgis from a pool of threads as soon as it is read.
+    No more sources are read or waiting to be written at once than there are
+    workers in both pools, so only that many decoded datasets are in memory.
+    Geospatial files are instead streamed straight into postgis from the
+    pool of threads when pyogrio is available.
+    Sources whose DCAT modified time matches the recorded load state are
+    skipped without being read, and sources whose contents are unchanged
+    are not rewritten.
+
+    Parameters
+    ==========
+    sources: iterable of (str, intake.Source, str or None)
+        Target table names, intake sources, and DCAT modified times.
+    schema: str
+        The schema into which to load the datasets.
+    state: dict, optional
+        The recorded load state, as returned by get_load_state.
+    simplify: dict, optional
+        Geometry simplification settings, keyed by table name
+        (see write_dataset).
+    read_workers: int
+        The number of processes used to read sources.
+    write_workers: int
+        The number of threads (and database connections) used to write tables.
+
+    Returns
+    =======
+    A list of (name, exception) pairs for the datasets that failed to load.
+    """
+    state = state or {}
+    simplify = simplify or {}
+    exceptions = []
+    writes = {}
+    # The read processes are spawned rather than forked, since this process
+    # may already hold database connections and running writer threads.
+    readers = ProcessPoolExecutor(
+        read_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    writers = ThreadPoolExecutor(write_workers)
+    with readers, writers:
+        queued = []
+        for name, source, modified in sources:
+            if modified is not None and state.get(name, {}).get("modified") == modified:
+                print(f"Skipping {name}, unmodified since {modified}", flush=True)
+                continue
+            if can_stream(source):
+                write = writers.submit(
+                    stream_dataset,
+                    name,
+                    source,
+                    modified,
+                    schema,
+                    state,
+                    simplify.get(name),
+                )
+                writes[write] = name
+                continue
+            queued.append((name, source, modified))
+
+        queued = iter(queued)
+        reads = {}
+        loading = {}
+        while True:
+            while len(reads) + len(loading) < read_workers + write_workers:
+                item = next(queued, None)
+                if item is None:
+                    break
+                name, source, modified = item
+                reads[readers.submit(read_and_hash_dataset, source)] = (name, modified)
+            if not reads and not loading:
+                break
+            done, _ = wait([*reads, *loading], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in loading:
+                    writes[future] = loading.pop(future)
+                    continue
+                # Drop every reference to the finished read, so that its dataset
+                # is only held by the write, until it has been written.
+                name, modified = reads.pop(future)
+                try:
+                    df, content_hash = future.result()
+                except Exception as e:
+                    exceptions.append((name, e))
+                    print(f"Error reading {name}", flush=True)
+                    continue
+                print(f"Read {name}, writing...", flush=True)
+                write = writers.submit(
+                    write_changed_dataset,
+                    name,
+                    df,
+                    content_hash,
+                    modified,
+                    schema,
+                    state,
+                    simplify.get(name),
+                )
+                loading[write] = name
+                del df, future
+            del done
+
+        for future in as_completed(writes):
+            name = writes[future]
+            try:
+                changed = future.result()
+                print(f"{'Loaded' if changed else 'Unchanged'} {name}", flush=True)
+            except Exception as e:
+                exceptions.append((name, e))
+                print(f"Error writing {name}", flush=True)
+    return exceptions
 
 
 if __name__ == "__main__":
@@ -46,10 +489,14 @@ if __name__ == "__main__":
     TABLE_NAME = os.environ.get("TABLE_NAME")
 
     # Create the schema if it does not exist
+    engine = get_engine()
     if not engine.dialect.has_schema(engine, SCHEMA):
         engine.execute(sqlalchemy.schema.CreateSchema(SCHEMA))
+    get_state_table(SCHEMA).create(engine, checkfirst=True)
 
-    # Load/construct the intake catalog to read
+    # Load/construct the intake catalog to read, along with any
+    # geometry simplification settings from its metadata.
+    simplify = {}
     if ITEM_ID and DCAT_URL and TABLE_NAME:
         # If provided with an item ID, DCAT URL, and table name,
         # construct a catalog from those.
@@ -65,11 +512,12 @@ if __name__ == "__main__":
         ]
     elif CATALOG_PATH:
         # If provided with a YAML catalog, use that.
-        catalogs = [
-            val.get()
-            for key, val in intake.open_catalog(CATALOG_PATH).items()
-            if val.container == "catalog"
-        ]
+        catalogs = []
+        for key, val in intake.open_catalog(CATALOG_PATH).items():
+            if val.container == "catalog":
+                catalogs.append(val.get())
+                metadata = val.describe().get("metadata") or {}
+                simplify.update(metadata.get("simplify", {}))
     else:
         # Otherwise, there was an error in the provided parameters.
         raise ValueError(
@@ -77,15 +525,18 @@ if __name__ == "__main__":
         )
 
     exceptions = []
+    sources = []
     for catalog in catalogs:
         for name, entry in catalog.items():
-            print(f"Loading {name}...", end="", flush=True)
             try:
-                load_dataset(name, entry.get(), SCHEMA)
-                print("done", flush=True)
+                sources.append((name, entry.get(), get_modified(entry)))
             except Exception as e:
                 exceptions.append((name, e))
-                print("error", flush=True)
+
+    # Set FORCE to reload every dataset regardless of the recorded load state.
+    state = {} if os.environ.get("FORCE") else get_load_state(SCHEMA)
+    print(f"Loading {len(sources)} datasets...", flush=True)
+    exceptions.extend(load_datasets(sources, SCHEMA, state, simplify))
 
     if len(exceptions):
         msg = "\n".join([f"{e[0]}: {e[1]}" for e in exceptions])
@@ -0,0 +1,320 @@
+"""
+Bulk loading of geodataframes into PostGIS.
+
+Rather than inserting rows one at a time into a freshly dropped table,
+geometries are converted to EWKB in a single vectorized pass and COPYed
+in chunks into a staging table. The spatial index is built once the data
+is loaded, and the staging table is then swapped in for the target table
+in the same transaction, so readers keep querying the old table until the
+new one is ready.
+
+Layers can also be streamed from Arrow record batches with WKB geometries,
+as produced by pyogrio, so that they never have to be held in memory.
+"""
+import io
+from typing import Callable, Dict, Optional
+
+import geopandas
+import numpy
+import pandas
+import pyarrow
+import pyarrow.csv
+import pyproj
+import shapely
+import sqlalchemy
+
+# The number of rows to COPY at a time.
+CHUNKSIZE = 50_000
+
+# The PostgreSQL types of object columns, by the kind of values they hold,
+# as inferred by pandas. Other object columns are written as TEXT.
+OBJECT_TYPES = {
+    "boolean": "BOOLEAN",
+    "integer": "BIGINT",
+    "floating": "DOUBLE PRECISION",
+    "mixed-integer-float": "DOUBLE PRECISION",
+    "decimal": "NUMERIC",
+    "date": "DATE",
+    "datetime": "TIMESTAMP",
+    "time": "TIME",
+}
+
+
+def get_geometry_type(geometry: geopandas.GeoSeries) -> str:
+    """
+    Get the PostGIS geometry type for a geoseries. This is the shared type
+    of all of the geometries, or GEOMETRY if they are mixed.
+    """
+    geom_types = geometry.geom_type.dropna().unique()
+    geometry_type = geom_types[0].upper() if len(geom_types) == 1 else "GEOMETRY"
+    if geometry.has_z.any():
+        geometry_type += "Z"
+    return geometry_type
+
+
+def get_srid(crs: Optional[pyproj.CRS]) -> int:
+    """
+    Get the SRID of a coordinate reference system, or 0 if it is unknown.
+    """
+    srid = pyproj.CRS.from_user_input(crs).to_epsg(min_confidence=25) if crs else None
+    return srid or 0
+
+
+def to_ewkb(geometry, srid: int) -> numpy.ndarray:
+    """
+    Convert a geoseries or array of geometries to an array of hex-encoded
+    EWKB, which PostGIS accepts as text input for geometry columns.
+    """
+    geoms = shapely.set_srid(numpy.asarray(geometry, dtype=object), srid)
+    return shapely.to_wkb(geoms, hex=True, include_srid=True)
+
+
+def get_sql_type(arrow_type: pyarrow.DataType) -> str:
+    """
+    Get the PostgreSQL type for an Arrow type. Types without a close
+    equivalent are written as TEXT.
+    """
+    types = pyarrow.types
+    if types.is_dictionary(arrow_type):
+        return get_sql_type(arrow_type.value_type)
+    if types.is_boolean(arrow_type):
+        return "BOOLEAN"
+    if (
+        types.is_int8(arrow_type)
+        or types.is_int16(arrow_type)
+        or types.is_uint8(arrow_type)
+    ):
+        return "SMALLINT"
+    if types.is_int32(arrow_type) or types.is_uint16(arrow_type):
+        return "INTEGER"
+    if types.is_int64(arrow_type) or types.is_uint32(arrow_type):
+        return "BIGINT"
+    if types.is_uint64(arrow_type):
+        return "NUMERIC(20)"
+    if types.is_float16(arrow_type) or types.is_float32(arrow_type):
+        return "REAL"
+    if types.is_float64(arrow_type):
+        return "DOUBLE PRECISION"
+    if types.is_decimal(arrow_type):
+        return f"NUMERIC({arrow_type.precision}, {arrow_type.scale})"
+    if types.is_date(arrow_type):
+        return "DATE"
+    if types.is_timestamp(arrow_type):
+        return "TIMESTAMP WITH TIME ZONE" if arrow_type.tz else "TIMESTAMP"
+    if types.is_time(arrow_type):
+        return "TIME"
+    return "TEXT"
+
+
+def get_frame_columns(df: pandas.DataFrame) -> Dict[str, str]:
+    """
+    Get the PostgreSQL types for the columns of a dataframe. Typed columns
+    are mapped through their Arrow types, and object columns by the values
+    they hold, as to_sql does, since an object column of dates or decimals
+    has no type of its own.
+    """
+    schema = pyarrow.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+    columns = {}
+    for field in schema:
+        column = df[field.name]
+        if pandas.api.types.is_object_dtype(column):
+            kind = pandas.api.types.infer_dtype(column, skipna=True)
+            columns[field.name] = OBJECT_TYPES.get(kind, "TEXT")
+        else:
+            columns[field.name] = get_sql_type(field.type)
+    return columns
+
+
+def create_staging_table(
+    conn,
+    staging: str,
+    columns: Dict[str, str],
+    geometry: str,
+    geometry_type: str,
+    srid: int,
+    schema: str,
+) -> None:
+    """
+    Create an empty staging table.
+
+    Parameters
+    ==========
+    conn: sqlalchemy.engine.Connection
+        The connection on which to create the table.
+    staging: str
+        The name of the staging table.
+    columns: dict
+        The names of the non-geometry columns of the table,
+        mapped to their PostgreSQL types.
+    geometry: str
+        The name of the geometry column.
+    geometry_type: str
+        The PostGIS geometry type of the geometry column.
+    srid: int
+        The SRID of the geometry column.
+    schema: str
+        The schema in which to create the table.
+    """
+    definitions = [f'"{name}" {sql_type}' for name, sql_type in columns.items()]
+    definitions.append(f'"{geometry}" geometry({geometry_type}, {srid})')
+    conn.execute(f'DROP TABLE IF EXISTS "{schema}"."{staging}"')
+    conn.execute(f'CREATE TABLE "{schema}"."{staging}" ({", ".join(definitions)})')
+
+
+def copy_csv(conn, staging: str, columns, buf, schema: str) -> None:
+    """
+    COPY a headerless CSV buffer into a staging table.
+    """
+    columns = ", ".join(f'"{c}"' for c in columns)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f'COPY "{schema}"."{staging}" ({columns}) FROM STDIN WITH (FORMAT csv)', buf
+    )
+
+
+def copy_chunk(conn, staging: str, df: geopandas.GeoDataFrame, schema: str, srid: int):
+    """
+    COPY a chunk of a geodataframe into a staging table.
+    """
+    geometry = df.geometry.name
+    chunk = pandas.DataFrame(df.drop(columns=[geometry]))
+    chunk[geometry] = to_ewkb(df.geometry, srid)
+    buf = io.StringIO()
+    chunk.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    copy_csv(conn, staging, chunk.columns, buf, schema)
+
+
+def copy_batch(
+    conn, staging: str, attributes: pyarrow.Table, geometry: str, ewkb, schema: str
+):
+    """
+    COPY a batch of Arrow attributes and hex EWKB geometries into a staging table.
+    """
+    table = attributes.append_column(geometry, pyarrow.array(ewkb, pyarrow.string()))
+    buf = io.BytesIO()
+    pyarrow.csv.write_csv(table, buf, pyarrow.csv.WriteOptions(include_header=False))
+    buf.seek(0)
+    copy_csv(conn, staging, table.column_names, buf, schema)
+
+
+def swap_staging_table(conn, name: str, staging: str, geometry: str, schema: str):
+    """
+    Index and analyze a loaded staging table, then replace the target
+    table with it.
+    """
+    index = f"idx_{name}_{geometry}"
+    conn.execute(
+        f'CREATE INDEX "idx_{staging}_{geometry}" '
+        f'ON "{schema}"."{staging}" USING GIST ("{geometry}")'
+    )
+    conn.execute(f'ANALYZE "{schema}"."{staging}"')
+    conn.execute(f'DROP TABLE IF EXISTS "{schema}"."{name}"')
+    conn.execute(f'ALTER TABLE "{schema}"."{staging}" RENAME TO "{name}"')
+    conn.execute(
+        f'ALTER INDEX "{schema}"."idx_{staging}_{geometry}" RENAME TO "{index}"'
+    )
+
+
+def write_postgis(
+    name: str,
+    df: geopandas.GeoDataFrame,
+    engine: sqlalchemy.engine.Engine,
+    schema: str,
+    chunksize: int = CHUNKSIZE,
+) -> None:
+    """
+    Write a geodataframe to PostGIS, replacing any existing table.
+
+    Parameters
+    ==========
+    name: str
+        The name of the target table.
+    df: geopandas.GeoDataFrame
+        The geodataframe to write.
+    engine: sqlalchemy.engine.Engine
+        The engine for the PostGIS database.
+    schema: str
+        The schema into which to load the geodataframe.
+    chunksize: int
+        The number of rows to COPY at a time.
+    """
+    staging = f"{name}__staging"
+    geometry = df.geometry.name
+    srid = get_srid(df.crs)
+    with engine.begin() as conn:
+        create_staging_table(
+            conn,
+            staging,
+            get_frame_columns(pandas.DataFrame(df.drop(columns=[geometry]))),
+            geometry,
+            get_geometry_type(df.geometry),
+            srid,
+            schema,
+        )
+        for start in range(0, len(df), chunksize):
+            copy_chunk(conn, staging, df.iloc[start : start + chunksize], schema, srid)
+        swap_staging_table(conn, name, staging, geometry, schema)
+
+
+def write_postgis_arrow(
+    tables: Dict[str, Optional[Callable]],
+    reader: pyarrow.RecordBatchReader,
+    meta: dict,
+    engine: sqlalchemy.engine.Engine,
+    schema: str,
+    geometry: str = "geometry",
+) -> None:
+    """
+    Stream Arrow record batches with WKB geometries into PostGIS, replacing
+    any existing tables. Only one batch is held in memory at a time.
+
+    Parameters
+    ==========
+    tables: dict
+        The names of the target tables, mapped to an optional function
+        transforming an array of geometries before it is written to that
+        table. Every table receives every batch.
+    reader: pyarrow.RecordBatchReader
+        The record batches to write.
+    meta: dict
+        Layer metadata, as returned by pyogrio.raw.open_arrow,
+        with the geometry column name, geometry type and CRS.
+    engine: sqlalchemy.engine.Engine
+        The engine for the PostGIS database.
+    schema: str
+        The schema into which to load the tables.
+    geometry: str
+        The name of the geometry column in the target tables.
+    """
+    source_geometry = meta.get("geometry_name") or "wkb_geometry"
+    srid = get_srid(meta.get("crs"))
+    # The declared type of a layer is not reliable (shapefiles declare
+    # multipolygon layers as polygons), so only the dimension is kept.
+    geometry_type = "GEOMETRY"
+    if any(z in (meta.get("geometry_type") or "") for z in ["Z", "3D"]):
+        geometry_type += "Z"
+    fields = [f for f in reader.schema if f.name != source_geometry]
+    columns = [f.name for f in fields]
+    staging = {name: f"{name}__staging" for name in tables}
+    with engine.begin() as conn:
+        for name in tables:
+            create_staging_table(
+                conn,
+                staging[name],
+                {f.name: get_sql_type(f.type) for f in fields},
+                geometry,
+                geometry_type,
+                srid,
+                schema,
+            )
+        for batch in reader:
+            attributes = pyarrow.Table.from_batches([batch]).select(columns)
+            geoms = shapely.from_wkb(
+                batch.column(source_geometry).to_numpy(zero_copy_only=False)
+            )
+            for name, transform in tables.items():
+                ewkb = to_ewkb(transform(geoms) if transform else geoms, srid)
+                copy_batch(conn, staging[name], attributes, geometry, ewkb, schema)
+        for name in tables:
+            swap_staging_table(conn, name, staging[name], geometry, schema)
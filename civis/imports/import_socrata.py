@@ -8,6 +8,7 @@ import logging
 import os
 from datetime import datetime
 import civis
+from civis_aqueduct_utils.httpclient import Session
 
 from socrata_helpers import (
     _store_and_attach_dataset_csv,
@@ -73,6 +74,13 @@ def main(
     )
     # define socrata cleint
 
+    session = Session()
+    session.headers.update(socrata_client.session.headers)
+    session.auth = socrata_client.session.auth
+    socrata_client.session = session
+    # sends socrata requests through a pooled session which retries
+    # rate limits and server errors
+
     civis_client = civis.APIClient()
     # define civis cleint
 
@@ -123,6 +131,9 @@ def main(
     # reads in socrata data in chunks (using offset and page_limit), and
     # appenda all to one csv and outputs path here
 
+    print(session.metrics.summary())
+    # reports the number and latency of requests to socrata
+
     data_file_name = f"{dataset_id}_extract_{datetime.now().strftime('%Y-%m-%d')}.csv"
     uploaded_file_id = _store_and_attach_dataset_csv(
         client=civis_client, csv_path=consolidated_csv_path, filename=data_file_name
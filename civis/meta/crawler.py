@@ -0,0 +1,310 @@
+"""
+Crawl the Civis data warehouses for the data catalog report.
+
+Rather than walking the intake catalogs one schema and one table at a time,
+the tables and columns of a whole database are fetched in a single bulk query
+against information_schema. Each table is fingerprinted by its columns and
+comment, and only tables which changed since the last crawl are described
+again, with one query per schema run concurrently. Table statistics, such as
+row estimates, sizes and vacuum times, change between crawls, so they are
+collected afresh each time in one query per database. The catalog is saved as
+a JSON snapshot on S3 (or locally in development) for the next crawl to reuse.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+import fsspec
+import sqlalchemy
+
+# The snapshot is kept on S3 by default, since the scheduled job does not keep
+# files between runs.
+SNAPSHOT_PATH = (
+    os.environ.get("CATALOG_SNAPSHOT_PATH")
+    or "s3://tmf-ita-data/civis-catalog/catalog-snapshot.json"
+)
+WORKERS = 4
+
+# Schemas which are not included in the catalog.
+EXCLUDED_SCHEMAS = ("pg_catalog", "information_schema", "tiger")
+
+COLUMNS_QUERY = sqlalchemy.text(
+    """
+    SELECT
+        c.table_schema,
+        c.table_name,
+        obj_description(t.oid, 'pg_class') AS description,
+        c.column_name,
+        c.data_type,
+        c.udt_name
+    FROM information_schema.columns c
+    JOIN pg_catalog.pg_namespace n ON n.nspname = c.table_schema
+    JOIN pg_catalog.pg_class t ON t.relnamespace = n.oid AND t.relname = c.table_name
+    WHERE c.table_schema NOT IN :excluded
+    ORDER BY c.table_schema, c.table_name, c.ordinal_position
+    """
+).bindparams(sqlalchemy.bindparam("excluded", expanding=True))
+
+# Table statistics for each dialect. Postgres does not record when a table
+# was last loaded, and Redshift only keeps a few days of vacuum, analyze and
+# insert history in its STL tables, so some timestamps may be missing.
+STATS_QUERIES = {
+    "postgresql": sqlalchemy.text(
+        """
+        SELECT
+            n.nspname,
+            c.relname,
+            c.reltuples::bigint AS rows,
+            pg_total_relation_size(c.oid) AS size,
+            s.n_dead_tup AS dead_rows,
+            greatest(s.last_vacuum, s.last_autovacuum) AS last_vacuum,
+            greatest(s.last_analyze, s.last_autoanalyze) AS last_analyze,
+            NULL AS last_load
+        FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_catalog.pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.relkind IN ('r', 'p', 'm') AND n.nspname NOT IN :excluded
+        """
+    ).bindparams(sqlalchemy.bindparam("excluded", expanding=True)),
+    "redshift": sqlalchemy.text(
+        """
+        SELECT
+            i."schema",
+            i."table",
+            i.estimated_visible_rows AS rows,
+            i.size::bigint * 1048576 AS size,
+            i.tbl_rows - i.estimated_visible_rows AS dead_rows,
+            v.last_vacuum,
+            a.last_analyze,
+            l.last_load,
+            i.unsorted
+        FROM svv_table_info i
+        LEFT JOIN (
+            SELECT table_id, max(eventtime) AS last_vacuum
+            FROM stl_vacuum GROUP BY table_id
+        ) v ON v.table_id = i.table_id
+        LEFT JOIN (
+            SELECT table_id, max(endtime) AS last_analyze
+            FROM stl_analyze GROUP BY table_id
+        ) a ON a.table_id = i.table_id
+        LEFT JOIN (
+            SELECT tbl, max(endtime) AS last_load
+            FROM stl_insert GROUP BY tbl
+        ) l ON l.tbl = i.table_id
+        WHERE i."schema" NOT IN :excluded
+        """
+    ).bindparams(sqlalchemy.bindparam("excluded", expanding=True)),
+}
+
+# PostGIS databases have a geometry_columns view with the SRIDs, which is
+# only queried for tables with geometry columns.
+SRIDS_QUERY = sqlalchemy.text(
+    """
+    SELECT f_table_name, srid
+    FROM geometry_columns
+    WHERE f_table_schema = :schema AND f_table_name IN :tables
+    """
+).bindparams(sqlalchemy.bindparam("tables", expanding=True))
+
+
+def get_tables(engine: sqlalchemy.engine.Engine) -> Dict[str, Dict[str, dict]]:
+    """
+    Get the comment and columns of every table in a database, as a mapping
+    from schema to table to a dict with the "description" of the table and its
+    "columns", a list of (name, data type, underlying type) triples.
+    """
+    tables = {}
+    for schema, table, description, *column in engine.execute(
+        COLUMNS_QUERY, excluded=list(EXCLUDED_SCHEMAS)
+    ):
+        entry = tables.setdefault(schema, {}).setdefault(
+            table, {"description": description, "columns": []}
+        )
+        entry["columns"].append(list(column))
+    return tables
+
+
+def get_table_stats(engine: sqlalchemy.engine.Engine) -> Dict[str, Dict[str, dict]]:
+    """
+    Get the row estimates, on-disk sizes in bytes, dead rows, and last vacuum,
+    analyze and load times of every table in a database, as a mapping
+    from schema to table to statistics.
+    """
+    query = STATS_QUERIES.get(engine.dialect.name)
+    if query is None:
+        return {}
+    stats = {}
+    for row in engine.execute(query, excluded=list(EXCLUDED_SCHEMAS)):
+        schema, table, *values = row
+        stats.setdefault(schema, {})[table] = {
+            key: value.isoformat() if hasattr(value, "isoformat") else value
+            for key, value in zip(row.keys()[2:], values)
+        }
+    return stats
+
+
+def fingerprint(table: dict) -> str:
+    """
+    Fingerprint a table from its comment and columns.
+    """
+    return hashlib.sha1(json.dumps(table, sort_keys=True).encode()).hexdigest()
+
+
+def describe_tables(
+    engine: sqlalchemy.engine.Engine, schema: str, tables: Dict[str, dict]
+) -> Dict[str, dict]:
+    """
+    Describe some of the tables in a schema.
+
+    Parameters
+    ==========
+    engine: sqlalchemy.engine.Engine
+        The engine for the database.
+    schema: str
+        The schema of the tables.
+    tables: dict
+        The tables to describe, mapped to their comments and columns,
+        as returned by get_tables.
+
+    Returns
+    =======
+    A mapping from table name to its catalog entry.
+    """
+    geometry_names = [
+        name
+        for name, table in tables.items()
+        if any(c[2] == "geometry" for c in table["columns"])
+    ]
+    srids = {}
+    if geometry_names and engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            srids = dict(
+                conn.execute(SRIDS_QUERY, schema=schema, tables=geometry_names)
+            )
+
+    entries = {}
+    for name, table in tables.items():
+        geometry = [c[0] for c in table["columns"] if c[2] == "geometry"]
+        entries[name] = {
+            "name": name,
+            "description": table["description"]
+            or f"Civis table {name} from {engine.url.database}",
+            "columns": [c[:2] for c in table["columns"]],
+            "geometry": geometry or None,
+            "crs": f"EPSG:{srids[name]}" if srids.get(name) else None,
+            "fingerprint": fingerprint(table),
+        }
+    return entries
+
+
+def crawl_database(
+    engine: sqlalchemy.engine.Engine,
+    previous: Optional[Dict[str, Dict[str, dict]]] = None,
+    workers: int = WORKERS,
+) -> Dict[str, Dict[str, dict]]:
+    """
+    Crawl a database, reusing the entries of tables which have not changed.
+    Table statistics are always collected afresh.
+
+    Parameters
+    ==========
+    engine: sqlalchemy.engine.Engine
+        The engine for the database.
+    previous: dict
+        The catalog of the database from the last crawl, if any.
+    workers: int
+        The number of schemas to describe concurrently.
+
+    Returns
+    =======
+    A mapping from schema to table to catalog entry.
+    """
+    previous = previous or {}
+    catalog = {}
+    changed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        stats = executor.submit(get_table_stats, engine)
+        for schema, tables in get_tables(engine).items():
+            catalog[schema] = {}
+            for name, table in tables.items():
+                entry = previous.get(schema, {}).get(name)
+                if entry and entry["fingerprint"] == fingerprint(table):
+                    catalog[schema][name] = entry
+                else:
+                    changed.setdefault(schema, {})[name] = table
+
+        print(
+            f"Describing {sum(len(t) for t in changed.values())} changed tables "
+            f"in {engine.url.database}",
+            flush=True,
+        )
+        futures = {
+            executor.submit(describe_tables, engine, schema, tables): schema
+            for schema, tables in changed.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            catalog[futures[future]].update(future.result())
+        stats = stats.result()
+
+    return {
+        schema: {
+            table: {**catalog[schema][table], "stats": stats.get(schema, {}).get(table)}
+            for table in sorted(catalog[schema])
+        }
+        for schema in sorted(catalog)
+    }
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> Dict[str, Dict[str, Dict[str, dict]]]:
+    """
+    Load the catalog snapshot from the last crawl, or an empty catalog
+    if there is none.
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    if not fs.exists(fs_path):
+        return {}
+    with fs.open(fs_path) as f:
+        return json.load(f)
+
+
+def save_snapshot(catalog: Dict[str, Dict[str, Dict[str, dict]]], path: str):
+    """
+    Save a catalog snapshot for the next crawl.
+    """
+    with fsspec.open(path, "w") as f:
+        json.dump(catalog, f)
+
+
+def crawl(
+    engines: Dict[str, sqlalchemy.engine.Engine],
+    path: str = SNAPSHOT_PATH,
+    workers: int = WORKERS,
+) -> Dict[str, Dict[str, Dict[str, dict]]]:
+    """
+    Crawl the data warehouses concurrently, updating the catalog snapshot.
+
+    Parameters
+    ==========
+    engines: dict
+        The engines for the databases to crawl, keyed by a display name
+        such as "PostgreSQL".
+    path: str
+        The path of the catalog snapshot.
+    workers: int
+        The number of schemas to describe concurrently in each database.
+
+    Returns
+    =======
+    A mapping from database name to schema to table to catalog entry.
+    """
+    snapshot = load_snapshot(path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(engines)) as executor:
+        futures = {
+            name: executor.submit(crawl_database, engine, snapshot.get(name), workers)
+            for name, engine in engines.items()
+        }
+        catalog = {name: future.result() for name, future in futures.items()}
+    save_snapshot(catalog, path)
+    return catalog
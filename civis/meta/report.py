@@ -0,0 +1,101 @@
+"""
+Render the data catalog as a static HTML report.
+
+The catalog is embedded in a small page as JSON. A compact index of schema
+and table names is rendered up front and searched on the client, while the
+table descriptions of each schema are kept in their own JSON block, which is
+only parsed and rendered, a page at a time, when the schema is expanded.
+This keeps the report quick to open however many tables there are.
+"""
+import json
+import os
+from typing import Dict
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "report.html")
+
+# The number of tables in the largest tables view of each database.
+LARGEST_TABLES = 100
+
+# The statistics shown in the largest tables view.
+STATS = ["rows", "size", "dead_rows", "last_vacuum", "last_analyze", "last_load"]
+
+
+def to_json(obj) -> str:
+    """
+    Serialize an object as compact JSON which is safe to embed in a script tag.
+    """
+    return json.dumps(obj, separators=(",", ":")).replace("</", "<\\/")
+
+
+def get_largest_tables(schemas: Dict[str, Dict[str, dict]], n: int) -> list:
+    """
+    Get the statistics of the n largest tables in a database, as a list of
+    [schema, table, *STATS] rows.
+    """
+    rows = []
+    for schema, tables in schemas.items():
+        for table, entry in tables.items():
+            if entry.get("stats"):
+                rows.append([schema, table] + [entry["stats"].get(k) for k in STATS])
+    return sorted(rows, key=lambda r: r[3] or 0, reverse=True)[:n]
+
+
+def build_index(
+    catalog: Dict[str, Dict[str, Dict[str, dict]]], largest: int = LARGEST_TABLES
+) -> list:
+    """
+    Build the index of the report, a list of [database, [[schema, [table, ...]],
+    ...], largest tables] triples. The schemas are referred to in the page
+    by their position.
+    """
+    return [
+        [
+            database,
+            [[schema, list(tables)] for schema, tables in schemas.items()],
+            get_largest_tables(schemas, largest),
+        ]
+        for database, schemas in catalog.items()
+    ]
+
+
+def build_schema(tables: Dict[str, dict]) -> list:
+    """
+    Build the JSON block of a schema, a list of the table entries
+    without the fields used only by the crawler.
+    """
+    return [
+        {k: v for k, v in entry.items() if k != "fingerprint"}
+        for entry in tables.values()
+    ]
+
+
+def build_report(
+    catalog: Dict[str, Dict[str, Dict[str, dict]]], template_path: str = TEMPLATE_PATH
+) -> str:
+    """
+    Render the data catalog as HTML.
+
+    Parameters
+    ==========
+    catalog: dict
+        A mapping from database name to schema to table to catalog entry,
+        as returned by crawler.crawl.
+    template_path: str
+        The path of the HTML template for the report.
+
+    Returns
+    =======
+    The HTML of the report.
+    """
+    blocks = []
+    for i, schemas in enumerate(catalog.values()):
+        for j, tables in enumerate(schemas.values()):
+            blocks.append(
+                f'<script type="application/json" id="schema-{i}-{j}">'
+                f"{to_json(build_schema(tables))}</script>"
+            )
+    with open(template_path) as f:
+        template = f.read()
+    return template.replace("{{INDEX}}", to_json(build_index(catalog))).replace(
+        "{{SCHEMAS}}", "\n".join(blocks)
+    )
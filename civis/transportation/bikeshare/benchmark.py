@@ -0,0 +1,185 @@
+"""
+Benchmark the normalization of the Tableau bikeshare trips export.
+
+Builds a synthetic export with the same layout as the Tableau view
+(one row per trip and measure) and compares the wall time and peak memory
+of the original groupby/pivot/merge reshape against `pivot_measures`.
+
+With --load, it also compares loading the cleaned trips into Postgres with
+an executemany INSERT ... ON CONFLICT DO NOTHING against the COPY-based
+`upsert`, both into an empty table and again when every trip already exists.
+This writes to a scratch table in the "benchmark" schema.
+
+Run it from the development environment, e.g.
+
+    python /app/civis/transportation/bikeshare/benchmark.py --trips 1000000 --load
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy
+import pandas
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+from civis_aqueduct_utils.db import get_engine, transaction, upsert
+from civis_aqueduct_utils.validate import validate
+
+from trips import bike_trips, pivot_measures, read_trips
+
+MEASURES = ["Distance", "Duration", "Est Calories", "Est Carbon Offset"]
+BENCHMARK_SCHEMA = "benchmark"
+
+
+def synthetic_export(n_trips, seed=0):
+    """
+    Construct a synthetic Tableau trips export.
+
+    Parameters
+    ----------
+    n_trips: int
+        The number of distinct trips. The export has one row per trip
+        and measure.
+    seed: int
+        The seed for the random number generator.
+
+    Returns
+    -------
+    A dataframe with the same columns as the Tableau export.
+    """
+    rng = numpy.random.default_rng(seed)
+    n_measures = len(MEASURES)
+    trip_ids = numpy.repeat(rng.permutation(n_trips) + 1_000_000, n_measures)
+    # Station ids are numeric strings, and names are text, as in the real export.
+    stations = numpy.array([str(i) for i in range(3000, 3300)], dtype=object)
+    start = pandas.Timestamp("2016-07-07") + pandas.to_timedelta(
+        rng.integers(0, 4 * 365 * 24 * 3600, n_trips), unit="s"
+    )
+    end = start + pandas.to_timedelta(rng.integers(60, 7200, n_trips), unit="s")
+    start_station = rng.choice(stations, n_trips)
+    end_station = rng.choice(stations, n_trips)
+
+    def per_trip(values):
+        return numpy.repeat(numpy.asarray(values), n_measures)
+
+    return pandas.DataFrame(
+        {
+            "Trip ID": trip_ids,
+            "Bike Type": per_trip(rng.choice(["standard", "electric"], n_trips)),
+            "End Datetime": per_trip(end),
+            "End Station": per_trip(end_station),
+            "End Station Name": per_trip("Station " + end_station),
+            "Name (group)": per_trip(rng.choice(["Walk-up", "Monthly Pass"], n_trips)),
+            "Optional Kiosk ID (group)": per_trip(rng.choice(["DTLA", "WLA"], n_trips)),
+            "Start Datetime": per_trip(start),
+            "Start Station": per_trip(start_station),
+            "Start Station Name": per_trip("Station " + start_station),
+            "Visible ID": per_trip(rng.integers(10000, 20000, n_trips).astype(str)),
+            "Measure Names": numpy.tile(MEASURES, n_trips),
+            "Measure Values": rng.random(n_trips * n_measures) * 1000,
+        }
+    )
+
+
+def groupby_pivot_merge(df):
+    """
+    The original reshape of the export, kept for comparison.
+    """
+    return pandas.merge(
+        df.set_index("Trip ID")
+        .groupby(level=0)
+        .first()
+        .drop(columns=["Measure Names", "Measure Values"]),
+        df.pivot(index="Trip ID", columns="Measure Names", values="Measure Values"),
+        left_index=True,
+        right_index=True,
+    ).reset_index()
+
+
+def measure(func, df):
+    """
+    Return the wall time in seconds and the peak traced memory in bytes
+    of calling func on df. The timing run is made without tracing,
+    as tracemalloc slows down allocation-heavy code.
+    """
+    start = time.perf_counter()
+    func(df)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def executemany_load(conn, table, df):
+    """
+    Load a dataframe by binding every row as statement parameters,
+    as the jobs used to.
+    """
+    insert = sqlalchemy.dialects.postgresql.insert(table).on_conflict_do_nothing()
+    conn.execute(insert, *df.to_dict(orient="records"))
+
+
+def copy_load(conn, table, df):
+    """
+    Load a dataframe with the COPY-based upsert.
+    """
+    upsert(table, df, conn=conn)
+
+
+def measure_load(func, table, df):
+    """
+    Return the wall time in seconds of loading df into an empty table with func,
+    and of loading it again when every row conflicts.
+    """
+    engine = get_engine()
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        with transaction() as conn:
+            func(conn, table, df)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--trips", type=int, default=1_000_000, help="The number of trips to generate"
+    )
+    parser.add_argument(
+        "--load", action="store_true", help="Also benchmark loading into Postgres"
+    )
+    args = parser.parse_args()
+
+    df = synthetic_export(args.trips)
+    print(f"Synthetic export: {len(df):,} rows, {args.trips:,} trips")
+    for name, func in [
+        ("groupby/pivot/merge", groupby_pivot_merge),
+        ("pivot_measures", pivot_measures),
+    ]:
+        elapsed, peak = measure(func, df)
+        print(f"{name:>20}: {elapsed:8.2f} s, peak {peak / 2**20:10.1f} MiB")
+
+    if args.load:
+        # Parse and validate the export as CSV, as the job does.
+        trips = pandas.concat(
+            read_trips([df.to_csv(index=False).encode()]), ignore_index=True
+        )
+        validate(bike_trips, trips)
+        engine = get_engine()
+        if not engine.dialect.has_schema(engine, BENCHMARK_SCHEMA):
+            engine.execute(sqlalchemy.schema.CreateSchema(BENCHMARK_SCHEMA))
+        table = bike_trips.tometadata(sqlalchemy.MetaData(), schema=BENCHMARK_SCHEMA)
+        for name, func in [("executemany", executemany_load), ("upsert", copy_load)]:
+            empty, conflicting = measure_load(func, table, trips)
+            print(
+                f"{name:>20}: {empty:8.2f} s into an empty table "
+                f"({len(trips) / empty:,.0f} rows/s), "
+                f"{conflicting:8.2f} s when all rows exist"
+            )
+        table.drop(engine)
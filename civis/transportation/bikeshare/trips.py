@@ -2,30 +2,48 @@
 Download Los Angeles Metro Bikeshare trip data from Tableau,
 upload to Postgres and S3.
 """
+import csv
 import io
 import os
-from urllib.parse import quote_plus
 
+import numpy
 import pandas
 import sqlalchemy
-import tableauserverclient
+from civis_aqueduct_utils.db import get_engine, transaction, upsert
+from civis_aqueduct_utils.validate import validate
 
 SCHEMA = "transportation"
 TABLE = "bike_trips"
 S3_DATA_PATH = "s3://tmf-ita-data/bikeshare_trips.parquet"
+S3_DATASET_PATH = "s3://tmf-ita-data/bikeshare_trips"
+# Written once every partition of the dataset has been written by a "backfill".
+# Parquet readers skip files starting with an underscore.
+S3_DATASET_MARKER = f"{S3_DATASET_PATH}/_BACKFILLED"
 
+# The Tableau server hosting the trips view, which can be pointed at a local
+# stand-in for testing.
+TABLEAU_SERVER = os.environ.get("TABLEAU_SERVER") or "https://10az.online.tableau.com"
 
-if os.environ.get("DEV"):
-    POSTGRES_URI = os.environ.get("POSTGRES_URI")
-else:
-    POSTGRES_URI = (
-        f"postgres://"
-        f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_USERNAME'])}:"
-        f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_PASSWORD'])}@"
-        f"{os.environ['POSTGRES_HOST']}:{os.environ['POSTGRES_PORT']}"
-        f"/{os.environ['POSTGRES_DATABASE']}"
-    )
-engine = sqlalchemy.create_engine(POSTGRES_URI)
+# The view filter used to restrict the Tableau export to recent trips,
+# and how far before the latest loaded trip to start fetching, so that
+# trips which show up late in Tableau are still picked up. The view must have
+# a field of this name holding the start time truncated to the day,
+# DATETRUNC('day', [Start Datetime]), as a filter on the timestamp itself
+# would only match trips starting exactly at midnight. Tableau ignores a
+# filter on a field the view does not have, so the export is checked for
+# trips from before the window.
+START_DATE_FILTER = os.environ.get("BIKESHARE_START_DATE_FILTER") or "Start Date"
+INCREMENTAL_LOOKBACK = pandas.Timedelta(days=2)
+
+# The most days to list in the view filter. After a longer gap between runs,
+# the whole history is fetched instead, to keep the request URL bounded.
+MAX_FILTER_DAYS = 31
+
+# The number of export rows to parse and load at a time.
+CHUNKSIZE = 500_000
+
+# The number of rows to fetch from Postgres at a time when exporting to S3.
+EXPORT_CHUNKSIZE = 200_000
 
 
 # Define the PostgreSQL Table using SQLAlchemy
@@ -51,25 +69,219 @@ bike_trips = sqlalchemy.Table(
 )
 
 
-def check_columns(table, df):
+def pivot_measures(df):
     """
-    Verify that a SQLAlchemy table and Pandas dataframe are compatible with
-    each other. If there is a mismatch, throws an AssertionError
+    Normalize a Tableau trips export into one row per trip.
+
+    The export duplicates each trip once per measure, with the measure in the
+    "Measure Names" and "Measure Values" columns. The fixed trip attributes are
+    the first non-null values for each trip, and the measures are scattered
+    into a preallocated array using the categorical codes of the trip ids and
+    measure names, so the frame is only traversed once. Rows without a trip id
+    are dropped, as are the measures of rows without a measure name.
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        The raw Tableau export.
+
+    Returns
+    -------
+    A dataframe with a "Trip ID" column, the trip attributes, and one column
+    per measure.
+
+    Raises
+    ------
+    ValueError
+        If a trip has more than one value for the same measure.
     """
-    # A map between type names for SQLAlchemy and Pandas. This is not exhaustive.
-    type_map = {
-        "INTEGER": "int64",
-        "VARCHAR": "object",
-        "FLOAT": "float64",
-        "DATETIME": "datetime64[ns]",
-    }
-    for column in table.columns:
-        assert column.name in df.columns
-        print(
-            f"Checking that {column.name}'s type {column.type} "
-            f"is consistent with {df.dtypes[column.name]}"
+    df = df[df["Trip ID"].notna()]
+    trip_codes, trip_ids = pandas.factorize(df["Trip ID"])
+    measure_codes, measure_names = pandas.factorize(df["Measure Names"], sort=True)
+
+    # Codes are assigned in order of first appearance, so a row is the first
+    # for its trip exactly when its code exceeds every code before it.
+    previous_max = numpy.maximum.accumulate(numpy.concatenate([[-1], trip_codes[:-1]]))
+    first_rows = numpy.flatnonzero(trip_codes > previous_max)
+
+    # Null measure names have the code -1, which would index the last measure.
+    named = measure_codes >= 0
+    cells = trip_codes[named] * len(measure_names) + measure_codes[named]
+    counts = numpy.bincount(cells, minlength=len(trip_ids) * len(measure_names))
+    if (counts > 1).any():
+        duplicated = trip_ids[
+            numpy.unique(numpy.flatnonzero(counts > 1) // len(measure_names))
+        ]
+        raise ValueError(
+            f"Trips have duplicate measures: {', '.join(map(str, duplicated[:5]))}"
+        )
+    measures = numpy.full(len(trip_ids) * len(measure_names), numpy.nan)
+    measures[cells] = df["Measure Values"].to_numpy(dtype="float64")[named]
+    measures = measures.reshape(len(trip_ids), len(measure_names))
+
+    attributes = df.drop(columns=["Trip ID", "Measure Names", "Measure Values"])
+    trips = attributes.take(first_rows)
+    trips.index = pandas.RangeIndex(len(trips))
+    # Attributes are usually repeated on every row of a trip, so the first row
+    # has them all, and only columns with gaps there need a groupby.
+    for column in trips.columns[trips.isna().any().to_numpy()]:
+        trips[column] = (
+            attributes[column].groupby(trip_codes).first().reset_index(drop=True)
         )
-        assert type_map[str(column.type)] == str(df.dtypes[column.name])
+    trips.insert(0, "Trip ID", trip_ids.to_numpy())
+    for i, measure in enumerate(measure_names):
+        trips[measure] = measures[:, i]
+    return trips
+
+
+class IterStream(io.RawIOBase):
+    """
+    A read-only file-like object wrapping an iterator of bytes chunks,
+    such as the CSV of a Tableau view, so it can be parsed as it downloads.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def column_name(name):
+    """
+    Convert a column name in the Tableau export to one in the bike_trips table.
+    """
+    return name.lower().strip().replace(" ", "_").replace("(", "").replace(")", "")
+
+
+def clean_trips(df):
+    """
+    Normalize a chunk of the Tableau export into one row per trip,
+    with column names matching the bike_trips table.
+    """
+    # The data has a weird structure where trip rows are duplicated, with variations
+    # on a "Measure" column, containing trip length, duration, etc. We pivot on that
+    # column to create a normalized table containing one row per trip.
+    df = pivot_measures(df)
+    return df.rename({n: column_name(n) for n in df.columns}, axis="columns")
+
+
+def export_dtypes(columns):
+    """
+    Get the dtypes with which to parse the columns of the Tableau export.
+
+    Every column which is text in the bike_trips table is read as strings, so
+    that station ids keep their formatting, and a chunk in which a column is
+    entirely null is not parsed as floats.
+    """
+    text = {c.name for c in bike_trips.columns if isinstance(c.type, sqlalchemy.String)}
+    return {n: str for n in columns if column_name(n) in text}
+
+
+def trip_starts(ids, flushed):
+    """
+    Find the first row of each trip in a chunk of the Tableau export.
+
+    Parameters
+    ----------
+    ids: numpy.ndarray
+        The trip id of each row in the chunk.
+    flushed: numpy.ndarray
+        The sorted ids of the trips in earlier chunks.
+
+    Returns
+    -------
+    The positions of the first row of each trip.
+
+    Raises
+    ------
+    ValueError
+        If the rows of a trip are not contiguous, or it was in an earlier chunk.
+    """
+    starts = numpy.flatnonzero(numpy.concatenate([[True], ids[1:] != ids[:-1]]))
+    trips = ids[starts]
+    ordered = numpy.sort(trips)
+    repeated = ordered[1:][ordered[1:] == ordered[:-1]]
+    if len(flushed):
+        found = flushed[numpy.searchsorted(flushed, trips).clip(max=len(flushed) - 1)]
+        repeated = numpy.concatenate([repeated, trips[found == trips]])
+    if len(repeated):
+        raise ValueError(
+            "Trips are split up in the Tableau export: "
+            f"{', '.join(map(str, numpy.unique(repeated)[:5]))}"
+        )
+    return starts
+
+
+def read_trips(export, chunksize=CHUNKSIZE):
+    """
+    Parse the Tableau trips export in chunks.
+
+    The rows for a single trip must be contiguous in the export, but may
+    straddle a chunk boundary, so the rows of the last trip in each chunk are
+    held back and prepended to the next one. Rows without a trip id are dropped.
+
+    Parameters
+    ----------
+    export: iterable of bytes
+        The CSV export, e.g. the `csv` attribute of a populated view.
+    chunksize: int
+        The number of export rows to parse at a time.
+
+    Returns
+    -------
+    A generator of cleaned trip dataframes.
+
+    Raises
+    ------
+    ValueError
+        If the rows of a trip are not contiguous.
+    """
+    stream = io.BufferedReader(IterStream(export))
+    # The header is read first, so that the dtypes can be given by column name.
+    header = stream.readline().decode("utf-8-sig")
+    columns = next(csv.reader([header]), [])
+    if not columns:
+        return
+    reader = pandas.read_csv(
+        stream,
+        header=None,
+        names=columns,
+        chunksize=chunksize,
+        parse_dates=["Start Datetime", "End Datetime"],
+        thousands=",",
+        dtype=export_dtypes(columns),
+    )
+    remainder = None
+    flushed = numpy.array([], dtype="int64")
+    for df in reader:
+        df = df[df["Trip ID"].notna()]
+        if remainder is not None:
+            df = pandas.concat([remainder, df], ignore_index=True)
+        if len(df) == 0:
+            continue
+        ids = df["Trip ID"].to_numpy(dtype="int64")
+        starts = trip_starts(ids, flushed)
+        remainder = df.iloc[starts[-1] :]
+        if len(starts) > 1:
+            flushed = numpy.sort(
+                numpy.concatenate([flushed, ids[starts[:-1]]]), kind="stable"
+            )
+            yield clean_trips(df.iloc[: starts[-1]])
+    if remainder is not None:
+        yield clean_trips(remainder)
 
 
 def create_table(**kwargs):
@@ -77,17 +289,71 @@ def create_table(**kwargs):
     Create the schema/tables to hold the bikeshare data.
     """
     print("Creating tables")
+    engine = get_engine()
     if not engine.dialect.has_schema(engine, SCHEMA):
         engine.execute(sqlalchemy.schema.CreateSchema(SCHEMA))
     metadata.create_all(engine)
 
 
-def load_pg_data(**kwargs):
+def get_latest_start_datetime():
+    """
+    Get the start time of the most recent trip loaded into Postgres,
+    or None if the table is empty.
+    """
+    query = sqlalchemy.select([sqlalchemy.func.max(bike_trips.c.start_datetime)])
+    with get_engine().connect() as conn:
+        return conn.execute(query).scalar()
+
+
+def incremental_csv_options(since):
+    """
+    Construct request options restricting the trips view export to trips
+    starting on or after a given time.
+
+    Tableau view filters match values rather than ranges, so this filters
+    on every calendar day from `since` through today.
+
+    Parameters
+    ----------
+    since: datetime
+        The earliest trip start time to fetch.
+
+    Returns
+    -------
+    A tableauserverclient.CSVRequestOptions instance, or None if the window
+    is longer than MAX_FILTER_DAYS, in which case all trips should be fetched.
+    """
+    import tableauserverclient
+
+    days = pandas.date_range(
+        pandas.Timestamp(since).normalize(), pandas.Timestamp.now().normalize()
+    )
+    if len(days) > MAX_FILTER_DAYS:
+        return None
+    options = tableauserverclient.CSVRequestOptions()
+    options.vf(START_DATE_FILTER, ",".join(days.strftime("%Y-%m-%d")))
+    return options
+
+
+def load_pg_data(incremental=True, **kwargs):
     """
     Load data from the Tableau server and upload it to Postgres.
+
+    Parameters
+    ----------
+    incremental: bool
+        Whether to only fetch trips starting after the most recent trip already
+        in Postgres (less a lookback window). If the table is empty, or this
+        is False, the entire trip history is fetched.
+
+    Returns
+    -------
+    The earliest start time of the chunks in which trips were inserted,
+    or None if no trips were inserted.
     """
+    import tableauserverclient
+
     # Sign in to the tableau server.
-    TABLEAU_SERVER = "https://10az.online.tableau.com"
     TABLEAU_SITENAME = "echo"
     TABLEAU_VERSION = "2.7"
     TABLEAU_USER = os.environ.get("BIKESHARE_USERNAME")
@@ -109,67 +375,208 @@ def load_pg_data(**kwargs):
     view = next(v for v in all_views if v.id == TRIP_TABLE_VIEW_ID)
     if not view:
         raise Exception("Cannot find the trips table!")
-    tableau_server.views.populate_csv(view)
-    df = pandas.read_csv(
-        io.BytesIO(b"".join(view.csv)),
-        parse_dates=["Start Datetime", "End Datetime"],
-        thousands=",",
-        dtype={"Visible ID": str, "End Station": str, "Start Station": str},
-    )
-
-    # The data has a weird structure where trip rows are duplicated, with variations
-    # on a "Measure" column, containing trip length, duration, etc. We pivot on that
-    # column to create a normalized table containing one row per trip.
-    print("Cleaning Data")
-    df = pandas.merge(
-        df.set_index("Trip ID")
-        .groupby(level=0)
-        .first()
-        .drop(columns=["Measure Names", "Measure Values"]),
-        df.pivot(index="Trip ID", columns="Measure Names", values="Measure Values"),
-        left_index=True,
-        right_index=True,
-    ).reset_index()
-    df = df.rename(
-        {
-            n: n.lower().strip().replace(" ", "_").replace("(", "").replace(")", "")
-            for n in df.columns
-        },
-        axis="columns",
-    )
-    check_columns(bike_trips, df)
+    since = get_latest_start_datetime() if incremental else None
+    options = None
+    if since is not None:
+        since = since - INCREMENTAL_LOOKBACK
+        options = incremental_csv_options(since)
+    if options is not None:
+        print(f"Fetching trips starting on or after {since}")
+        tableau_server.views.populate_csv(view, options)
+    else:
+        print("Fetching all trips")
+        tableau_server.views.populate_csv(view)
 
-    # Upload the final dataframe to Postgres. Since pandas timestamps conform to the
-    # datetime interface, psycopg can correctly handle the timestamps upon insert.
+    # Parse, clean, and upload the export a chunk at a time as it downloads, so
+    # we never hold the full trip history in memory. Trips in the lookback window
+    # are already loaded, and are skipped on conflict. Each chunk is committed
+    # as it is loaded.
     print("Uploading to PG")
-    insert = sqlalchemy.dialects.postgresql.insert(bike_trips).on_conflict_do_nothing()
-    conn = engine.connect()
-    conn.execute(insert, *df.to_dict(orient="record"))
+    total = 0
+    fetched = 0
+    stale = 0
+    earliest = None
+    for df in read_trips(view.csv):
+        fetched += len(df)
+        if options is not None:
+            stale += (df.start_datetime < since.normalize()).sum()
+        if since is not None:
+            df = df[df.start_datetime >= since]
+        if len(df) == 0:
+            continue
+        validate(bike_trips, df)
+        inserted, skipped = upsert(bike_trips, df)
+        total += inserted
+        if inserted:
+            start = df.start_datetime.min()
+            earliest = start if earliest is None else min(earliest, start)
+        print(f"Uploaded {total} trips, skipped {skipped} already loaded")
+    if stale:
+        print(
+            f"Warning: the Tableau export has {stale} trips from before "
+            f"{since.normalize():%Y-%m-%d}, so the view is probably not filtered "
+            f'by "{START_DATE_FILTER}". Set BIKESHARE_START_DATE_FILTER to the '
+            "name of its start date field."
+        )
+    # The window starts before the latest loaded trip, so it always has trips,
+    # and an empty export means the filter matched nothing rather than that
+    # there were no new trips.
+    if since is not None and fetched == 0:
+        raise Exception(f"The Tableau export has no trips since {since}")
+    return earliest
 
 
 def migrate_data():
     """
     Migrate data *from* S3 into the data warehouse.
 
+    The data is read from the partitioned dataset, or from the single-file
+    snapshot if the dataset has not been completed yet by a "backfill".
     This will delete all existing data in the table before migrating.
     """
-    # Clear the table of all existing data
-    engine.execute(f'TRUNCATE TABLE "{SCHEMA}"."{TABLE}"')
-    # Read the data from s3.
-    df = pandas.read_parquet(S3_DATA_PATH)
-    check_columns(bike_trips, df)
-    # Upload the new data
-    insert = sqlalchemy.dialects.postgresql.insert(bike_trips)
-    conn = engine.connect()
-    conn.execute(insert, *df.to_dict(orient="record"))
+    if is_backfilled():
+        # Read the data from s3, dropping the partition column.
+        df = pandas.read_parquet(S3_DATASET_PATH).drop(columns=["month"])
+    else:
+        print(f"{S3_DATASET_PATH} has not been backfilled, reading {S3_DATA_PATH}")
+        df = pandas.read_parquet(S3_DATA_PATH)
+    validate(bike_trips, df)
+    # Clear the table of all existing data and upload the new data
+    # in one transaction, so a failed migration leaves the table as it was.
+    with transaction() as conn:
+        conn.execute(f'TRUNCATE TABLE "{SCHEMA}"."{TABLE}"')
+        upsert(bike_trips, df, conn=conn)
+
+
+def parquet_schema(table):
+    """
+    Construct an Arrow schema for a SQLAlchemy table, so that every chunk of
+    an export is written with the same types, even if a chunk has a column
+    which is entirely null.
+    """
+    import pyarrow
+
+    # A map between type names for SQLAlchemy and Arrow. This is not exhaustive.
+    type_map = {
+        "INTEGER": pyarrow.int64(),
+        "VARCHAR": pyarrow.string(),
+        "FLOAT": pyarrow.float64(),
+        "DATETIME": pyarrow.timestamp("ns"),
+    }
+    return pyarrow.schema(
+        [
+            pyarrow.field(c.name, type_map[str(c.type)], nullable=c.nullable)
+            for c in table.columns
+        ]
+    )
+
+
+def write_parquet(query, path):
+    """
+    Stream the results of a query into a parquet file.
+
+    The rows are fetched with a server-side cursor and written a chunk at a
+    time as row groups, so memory use is bounded by EXPORT_CHUNKSIZE.
+
+    Parameters
+    ----------
+    query: sqlalchemy.sql.Select
+        A query selecting the columns of bike_trips.
+    path: str
+        The local or S3 path to which to write the parquet file.
+
+    Returns
+    -------
+    The number of rows written.
+    """
+    import fsspec
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = parquet_schema(bike_trips)
+    rows = 0
+    with get_engine().connect() as conn, fsspec.open(path, "wb") as f:
+        conn = conn.execution_options(stream_results=True)
+        with pyarrow.parquet.ParquetWriter(f, schema) as writer:
+            for df in pandas.read_sql_query(query, conn, chunksize=EXPORT_CHUNKSIZE):
+                writer.write_table(
+                    pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False)
+                )
+                rows += len(df)
+    return rows
 
 
 def load_to_s3():
     """
-    Copy data from the data warehouse *to* S3.
+    Copy data from the data warehouse *to* S3 as a single parquet file.
+    This is kept alongside the partitioned dataset for existing consumers.
+    """
+    rows = write_parquet(sqlalchemy.select([bike_trips]), S3_DATA_PATH)
+    print(f"Wrote {rows} trips to {S3_DATA_PATH}")
+
+
+def load_partitions_to_s3(months):
+    """
+    Copy data from the data warehouse *to* S3 as a parquet dataset
+    partitioned by the month of the trip start time.
+
+    Parameters
+    ----------
+    months: list of pandas.Period
+        The months to write. Other partitions are left untouched.
+    """
+    for month in months:
+        query = sqlalchemy.select([bike_trips]).where(
+            sqlalchemy.and_(
+                bike_trips.c.start_datetime >= month.start_time,
+                bike_trips.c.start_datetime < (month + 1).start_time,
+            )
+        )
+        path = f"{S3_DATASET_PATH}/month={month}/trips.parquet"
+        rows = write_parquet(query, path)
+        print(f"Wrote {rows} trips to {path}")
+
+
+def is_backfilled():
+    """
+    Whether every partition of the dataset has been written by a "backfill",
+    rather than only the months which nightly loads have touched.
+    """
+    import fsspec
+
+    fs, _, (path,) = fsspec.get_fs_token_paths(S3_DATASET_MARKER)
+    return fs.exists(path)
+
+
+def backfill():
+    """
+    Write every monthly partition of the dataset, and then the marker
+    showing that the dataset is complete.
+    """
+    import fsspec
+
+    load_partitions_to_s3(get_all_months())
+    with fsspec.open(S3_DATASET_MARKER, "w") as f:
+        f.write(pandas.Timestamp.now().isoformat())
+    print(f"Wrote {S3_DATASET_MARKER}")
+
+
+def get_months_since(start):
+    """
+    Get every month from the month of a given time through the current month,
+    which are the partitions a load of trips starting at that time can change.
+    """
+    return list(pandas.period_range(start, pandas.Timestamp.now(), freq="M"))
+
+
+def get_all_months():
+    """
+    Get every month in which a trip started.
     """
-    df = pandas.read_sql_table(TABLE, engine, schema=SCHEMA)
-    df.to_parquet(S3_DATA_PATH)
+    month = sqlalchemy.func.date_trunc("month", bike_trips.c.start_datetime)
+    query = sqlalchemy.select([month]).distinct().order_by(month)
+    with get_engine().connect() as conn:
+        return [pandas.Period(m, freq="M") for (m,) in conn.execute(query)]
 
 
 if __name__ == "__main__":
@@ -178,7 +585,17 @@ if __name__ == "__main__":
     create_table()
     if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
         migrate_data()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "backfill":
+        backfill()
     else:
-        load_pg_data()
+        # Pass "full" to re-fetch the entire trip history from Tableau.
+        full = len(sys.argv) >= 2 and sys.argv[1] == "full"
+        earliest = load_pg_data(incremental=not full)
         if not os.environ.get("DEV"):
+            # Until the dataset has been backfilled, it would hold only recent
+            # months, so only the single-file snapshot is written.
+            if earliest is not None and is_backfilled():
+                load_partitions_to_s3(get_months_since(earliest))
+            elif earliest is not None:
+                print(f"{S3_DATASET_PATH} has not been backfilled, skipping it")
             load_to_s3()
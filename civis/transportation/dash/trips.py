@@ -1,31 +1,25 @@
 """
 Download LADOT Downtown DASH data, and upload it to Postgres and S3.
 """
+import io
 import os
 from base64 import b64encode
-from urllib.parse import quote_plus
 
 import pandas
-import requests
 import sqlalchemy
+from civis_aqueduct_utils.db import get_engine, transaction, upsert
+from civis_aqueduct_utils.validate import validate
 
 S3_BUCKET = "s3://tmf-ita-data/dash"
 SCHEMA = "transportation"
 TABLE = "dash_trips"
 LOCAL_TIMEZONE = "US/Pacific"
 
-
-if os.environ.get("DEV"):
-    POSTGRES_URI = os.environ.get("POSTGRES_URI")
-else:
-    POSTGRES_URI = (
-        f"postgres://"
-        f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_USERNAME'])}:"
-        f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_PASSWORD'])}@"
-        f"{os.environ['POSTGRES_HOST']}:{os.environ['POSTGRES_PORT']}"
-        f"/{os.environ['POSTGRES_DATABASE']}"
-    )
-engine = sqlalchemy.create_engine(POSTGRES_URI)
+# The base URL of the Syncromatics API, which can be pointed at a local
+# stand-in for testing.
+SYNCROMATICS_URL = (
+    os.environ.get("SYNCROMATICS_URL") or "https://track-api.syncromatics.com/1"
+)
 
 # Get data from the previous day
 yesterday = (pandas.Timestamp.now() - pandas.Timedelta(days=1)).date()
@@ -69,44 +63,28 @@ dash_trips = sqlalchemy.Table(
 
 
 def get_bearer_token():
+    from civis_aqueduct_utils.httpclient import get_session
+
     user = os.environ.get("SYNCROMATICS_USERNAME")
     password = os.environ.get("SYNCROMATICS_PASSWORD")
     login = b64encode(f"{user}:{password}".encode()).decode()
 
-    r = requests.post(
-        "https://track-api.syncromatics.com/1/login",
+    # Logging in again only issues another token, so it is safe to retry.
+    r = get_session().post(
+        f"{SYNCROMATICS_URL}/login",
         headers={"Authorization": f"Basic {login}"},
+        retry=True,
     )
     r.raise_for_status()
     return r.content.decode()
 
 
-def check_columns(table, df):
-    """
-    Verify that a SQLAlchemy table and Pandas dataframe are compatible with
-    each other. If there is a mismatch, throws an AssertionError
-    """
-    # A map between type names for SQLAlchemy and Pandas. This is not exhaustive.
-    type_map = {
-        "INTEGER": "int64",
-        "VARCHAR": "object",
-        "FLOAT": "float64",
-        "DATETIME": "datetime64[ns, US/Pacific]",
-    }
-    for column in table.columns:
-        assert column.name in df.columns
-        print(
-            f"Checking that {column.name}'s type {column.type} "
-            f"is consistent with {df.dtypes[column.name]}"
-        )
-        assert type_map[str(column.type)] == str(df.dtypes[column.name])
-
-
 def create_table():
     """
     Create the schema/tables to hold the hare data.
     """
     print("Creating tables")
+    engine = get_engine()
     if not engine.dialect.has_schema(engine, SCHEMA):
         engine.execute(sqlalchemy.schema.CreateSchema(SCHEMA))
     metadata.create_all(engine)
@@ -116,18 +94,21 @@ def load_pg_data():
     """
     Query trips data from the Syncromatics REST API and upload it to Postgres.
     """
+    from civis_aqueduct_utils.httpclient import get_session
+
     # Fetch the data from the rest API for the previous day.
     DOWNTOWN_DASH_ID = "LADOTDT"
     token = get_bearer_token()
     print(f"Fetching DASH data for {yesterday}")
-    r = requests.get(
-        f"https://track-api.syncromatics.com/1/{DOWNTOWN_DASH_ID}"
+    r = get_session().get(
+        f"{SYNCROMATICS_URL}/{DOWNTOWN_DASH_ID}"
         f"/exports/stop_times.json?start={yesterday}&end={yesterday}",
         headers={"Authorization": f"Bearer {token}"},
     )
+    r.raise_for_status()
     time_cols = ["arrive", "depart", "scheduled_arrive", "scheduled_depart"]
     df = pandas.read_json(
-        r.content,
+        io.BytesIO(r.content),
         convert_dates=time_cols,
         dtype={
             "run_name": str,
@@ -152,14 +133,12 @@ def load_pg_data():
     for col in time_cols:
         df[col] = df[col].dt.tz_convert(LOCAL_TIMEZONE)
 
-    check_columns(dash_trips, df)
+    validate(dash_trips, df)
 
-    # Upload the final dataframe to Postgres. Since pandas timestamps conform to the
-    # datetime interface, psycopg can correctly handle the timestamps upon insert.
+    # Upload the final dataframe to Postgres, skipping stops already loaded.
     print("Uploading to PG")
-    insert = sqlalchemy.dialects.postgresql.insert(dash_trips).on_conflict_do_nothing()
-    conn = engine.connect()
-    conn.execute(insert, *df.to_dict(orient="record"))
+    inserted, skipped = upsert(dash_trips, df)
+    print(f"Inserted {inserted} stops, skipped {skipped} already loaded")
 
 
 def load_to_s3(date):
@@ -172,7 +151,7 @@ def load_to_s3(date):
     FROM "{SCHEMA}"."{TABLE}"
     WHERE DATE(scheduled_depart AT TIME ZONE 'PST') = '{date}'
     """
-    df = pandas.read_sql_query(sql, engine)
+    df = pandas.read_sql_query(sql, get_engine())
     if len(df) == 0:
         print(f"Got no trips for {date}. Exiting early")
         return
@@ -189,19 +168,20 @@ def migrate_data():
 
     This will delete all existing data in the table before migrating.
     """
-    # Clear the table of all existing data
-    engine.execute(f'TRUNCATE TABLE "{SCHEMA}"."{TABLE}"')
     # Read the data from s3.
     df = pandas.read_parquet("s3://tmf-data/dash-trips.parquet", engine="pyarrow")
-    # Upload the new data
-    insert = sqlalchemy.dialects.postgresql.insert(dash_trips).on_conflict_do_nothing()
-    conn = engine.connect()
-    conn.execute(insert, *df.to_dict(orient="record"))
+    # Clear the table of all existing data and upload the new data
+    # in one transaction, so a failed migration leaves the table as it was.
+    with transaction() as conn:
+        conn.execute(f'TRUNCATE TABLE "{SCHEMA}"."{TABLE}"')
+        upsert(dash_trips, df, conn=conn)
 
 
 if __name__ == "__main__":
     import sys
 
+    from civis_aqueduct_utils.httpclient import get_session
+
     create_table()
     if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
         migrate_data()
@@ -209,3 +189,4 @@ if __name__ == "__main__":
         load_pg_data()
         if not os.environ.get("DEV"):
             load_to_s3(yesterday)
+        print(get_session().metrics.summary())
@@ -0,0 +1,496 @@
+"""
+Local stand-ins for the vendor endpoints used by the transportation jobs.
+
+Each fake serves deterministic synthetic payloads at a configurable scale,
+or replays a recorded one, so that the jobs can be benchmarked and
+regression-tested without touching the live APIs:
+
+- Syncromatics: login and the stop_times.json export used by dash/trips.py
+- Tableau REST: server info, sign in, views and the view data CSV used by
+  bikeshare/trips.py
+- The Metro ridership ASPX form used by metro/ridership.py
+
+The jobs are pointed at them with the SYNCROMATICS_URL, TABLEAU_SERVER and
+RIDERSHIP_URL environment variables. Run this module to serve all three
+and print those variables, e.g.
+
+    python /app/civis/transportation/loadtest/fakes.py --stops 100000
+"""
+import argparse
+import datetime
+import html
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy
+import pandas
+
+BIKESHARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "bikeshare"
+)
+
+# The ID of the trips view which bikeshare/trips.py looks up.
+TRIP_TABLE_VIEW_ID = "7530c937-887e-42da-aa50-2a11d279bf51"
+
+# The number of trips to generate and send at a time in the Tableau export.
+EXPORT_CHUNKSIZE = 50_000
+
+TABLEAU_NAMESPACE = "http://tableau.com/api"
+RIDERSHIP_TABLE_ID = "ContentPlaceHolder1_ASPxRoundPanel2_gvRidership"
+DAY_TYPES = ["Weekday", "Saturday", "Sunday/Holiday"]
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server on a free local port, running in the background.
+
+    Parameters
+    ----------
+    handler: BaseHTTPRequestHandler subclass
+        The fake to serve.
+    latency: float
+        Seconds to wait before each response, to simulate the network.
+    fail_every: int
+        If set, answer every nth request with a 503, to exercise retries.
+    **options
+        Options of the fake, such as the scale of its payloads.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, fail_every=0, **options):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.options = options
+        self.requests = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self):
+        """
+        Count a request, returning whether it should fail.
+        """
+        with self._lock:
+            self.requests += 1
+            return bool(self.fail_every) and self.requests % self.fail_every == 0
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Common handling for the fakes, which implement `route`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request(b"")
+
+    def do_POST(self):
+        self.handle_request(self.rfile.read(int(self.headers["Content-Length"] or 0)))
+
+    def handle_request(self, body):
+        time.sleep(self.server.latency)
+        if self.server.count():
+            return self.send(503, b"Service Unavailable", "text/plain")
+        url = urlsplit(self.path)
+        self.route(url.path, parse_qs(url.query), body)
+
+    def send(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_chunks(self, chunks, content_type):
+        """
+        Stream a response with chunked transfer encoding.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_file(self, path, content_type):
+        with open(path, "rb") as f:
+            self.send_chunks(iter(lambda: f.read(2 ** 20), b""), content_type)
+
+    def route(self, path, query, body):
+        raise NotImplementedError
+
+
+def synthetic_stop_times(n_stops, date, seed=0):
+    """
+    Construct a synthetic Syncromatics stop times export for a day,
+    as a list of JSON records.
+
+    Parameters
+    ----------
+    n_stops: int
+        The number of stops. Every trip serves 20 stops, and the scheduled
+        arrival, stop and trip of each is unique, as in the real export.
+    date: str
+        The day of the export, e.g. "2020-03-01".
+    seed: int
+        The seed for the random number generator.
+
+    Returns
+    -------
+    The export as JSON.
+    """
+    rng = numpy.random.default_rng(seed)
+    stops_per_trip = 20
+    i = numpy.arange(n_stops)
+    trip = i // stops_per_trip
+    stop = i % stops_per_trip
+    scheduled = (
+        pandas.Timestamp(date, tz="US/Pacific")
+        + pandas.to_timedelta(5 * 3600 + 60 * (trip % 1000) + 120 * stop, unit="s")
+    ).tz_convert("UTC")
+    arrive = scheduled + pandas.to_timedelta(rng.integers(-60, 300, n_stops), unit="s")
+    depart = arrive + pandas.to_timedelta(rng.integers(0, 60, n_stops), unit="s")
+    ons = rng.integers(0, 10, n_stops)
+    offs = rng.integers(0, 10, n_stops)
+    route = numpy.array(["A", "B", "D", "E", "F"])[trip % 5]
+
+    def href(kind, values):
+        return [f"/1/LADOTDT/{kind}/{v}" for v in values]
+
+    df = pandas.DataFrame(
+        {
+            "arrival_passengers": ons + offs,
+            "arrive": arrive,
+            "arrive_variance": rng.normal(60, 30, n_stops).round(1),
+            "block_href": href("blocks", trip % 40),
+            "depart": depart,
+            "depart_variance": rng.normal(60, 30, n_stops).round(1),
+            "departure_passengers": ons,
+            "driver_first_name": "Driver",
+            "driver_href": href("drivers", trip % 40),
+            "driver_last_name": (trip % 40).astype(str),
+            "offs": offs,
+            "ons": ons,
+            "pattern_href": href("patterns", trip % 10),
+            "pattern_name": [f"DASH {r} Loop" for r in route],
+            "route_href": href("routes", route),
+            "route_name": [f"DASH {r}" for r in route],
+            "run_href": href("runs", trip % 40),
+            "run_name": (trip % 40).astype(str),
+            "scheduled_arrive": scheduled,
+            "scheduled_depart": scheduled + pandas.Timedelta(seconds=30),
+            "stop_href": href("stops", stop),
+            "stop_name": [f"Stop {s}" for s in stop],
+            "trip_id": trip + 1_000_000,
+            "trip_href": href("trips", trip),
+            "trip_name": [f"Trip {t}" for t in trip],
+            "vehicle_href": href("vehicles", trip % 30),
+            "vehicle_name": (trip % 30 + 100).astype(str),
+        }
+    )
+    return df.to_json(orient="records", date_format="iso")
+
+
+class SyncromaticsHandler(FakeHandler):
+    """
+    The Syncromatics track API. Options:
+
+    stops: int
+        The number of stops in each stop times export.
+    stop_times: str
+        The path of a recorded stop times export to replay instead.
+    """
+
+    TOKEN = "fake-syncromatics-token"
+
+    def route(self, path, query, body):
+        if path == "/1/login" and self.command == "POST":
+            if not self.headers.get("Authorization", "").startswith("Basic "):
+                return self.send(401, b"Unauthorized", "text/plain")
+            return self.send(200, self.TOKEN.encode(), "text/plain")
+
+        if path.endswith("/exports/stop_times.json"):
+            if self.headers.get("Authorization") != f"Bearer {self.TOKEN}":
+                return self.send(401, b"Unauthorized", "text/plain")
+            if self.server.options.get("stop_times"):
+                return self.send_file(
+                    self.server.options["stop_times"], "application/json"
+                )
+            date = query["start"][0]
+            stops = self.server.options.get("stops", 10_000)
+            content = synthetic_stop_times(stops, date).encode()
+            return self.send(200, content, "application/json")
+
+        self.send(404, b"Not Found", "text/plain")
+
+
+def tableau_response(content):
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<tsResponse xmlns="{TABLEAU_NAMESPACE}">{content}</tsResponse>'
+    ).encode()
+
+
+def synthetic_trips_csv(n_trips):
+    """
+    Generate a synthetic Tableau trips export as CSV, a chunk at a time,
+    using the generator from the bikeshare benchmark.
+    """
+    if BIKESHARE_DIR not in sys.path:
+        sys.path.append(BIKESHARE_DIR)
+    from benchmark import synthetic_export
+
+    for i, start in enumerate(range(0, n_trips, EXPORT_CHUNKSIZE)):
+        df = synthetic_export(min(EXPORT_CHUNKSIZE, n_trips - start), seed=i)
+        # Keep trip IDs unique across chunks.
+        df["Trip ID"] += start
+        yield df.to_csv(index=False, header=i == 0).encode()
+
+
+class TableauHandler(FakeHandler):
+    """
+    The Tableau REST API. Options:
+
+    trips: int
+        The number of trips in the trips view export.
+    trips_csv: str
+        The path of a recorded trips view export to replay instead.
+    """
+
+    TOKEN = "fake-tableau-token"
+    SITE_ID = "fake-site-id"
+
+    def route(self, path, query, body):
+        if path.endswith("/serverInfo"):
+            return self.send(
+                200,
+                tableau_response(
+                    '<serverInfo><productVersion build="20201.0.0">2020.1.0'
+                    "</productVersion><restApiVersion>3.7</restApiVersion>"
+                    "</serverInfo>"
+                ),
+                "application/xml",
+            )
+
+        if path.endswith("/auth/signin") and self.command == "POST":
+            site = re.search(rb'contentUrl="([^"]*)"', body)
+            return self.send(
+                200,
+                tableau_response(
+                    f'<credentials token="{self.TOKEN}">'
+                    f'<site id="{self.SITE_ID}" '
+                    f'contentUrl="{site.group(1).decode() if site else ""}"/>'
+                    f'<user id="fake-user-id"/></credentials>'
+                ),
+                "application/xml",
+            )
+
+        if self.headers.get("X-Tableau-Auth") != self.TOKEN:
+            return self.send(401, b"Unauthorized", "text/plain")
+
+        if path.endswith(f"/sites/{self.SITE_ID}/views"):
+            return self.send(
+                200,
+                tableau_response(
+                    '<pagination pageNumber="1" pageSize="100" totalAvailable="1"/>'
+                    f'<views><view id="{TRIP_TABLE_VIEW_ID}" name="Trips" '
+                    'contentUrl="Trips/sheets/Trips">'
+                    '<workbook id="fake-workbook-id"/><owner id="fake-user-id"/>'
+                    "</view></views>"
+                ),
+                "application/xml",
+            )
+
+        if path.endswith(f"/views/{TRIP_TABLE_VIEW_ID}/data"):
+            if self.server.options.get("trips_csv"):
+                return self.send_file(self.server.options["trips_csv"], "text/csv")
+            trips = self.server.options.get("trips", 100_000)
+            return self.send_chunks(synthetic_trips_csv(trips), "text/csv")
+
+        self.send(404, b"Not Found", "text/plain")
+
+
+def ridership_years(n_years):
+    """
+    The years offered by the ridership form, all in the past,
+    so that every month of each is fetched.
+    """
+    year = datetime.date.today().year
+    return [str(y) for y in range(year - n_years, year)]
+
+
+class RidershipHandler(FakeHandler):
+    """
+    The Metro ridership ASPX form. Options:
+
+    lines: int
+        The number of lines offered by the form.
+    years: int
+        The number of years offered by the form.
+    viewstate_size: int
+        The size of the __VIEWSTATE field, which makes up most of each page.
+    """
+
+    def viewstate(self):
+        size = self.server.options.get("viewstate_size", 20_000)
+        return "A" * size
+
+    def route(self, path, query, body):
+        lines = range(1, self.server.options.get("lines", 20) + 1)
+        years = ridership_years(self.server.options.get("years", 1))
+        hidden = (
+            f'<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" '
+            f'value="{self.viewstate()}" />'
+            '<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" '
+            'value="fake-event-validation" />'
+        )
+
+        if self.command == "GET":
+            options = "".join(f'<option value="{n}">{n}</option>' for n in lines)
+            year_options = "".join(f'<option value="{y}">{y}</option>' for y in years)
+            page = (
+                f"<html><body><form>{hidden}"
+                '<select id="ContentPlaceHolder1_lbLines">'
+                f'<option value="All">All</option>{options}</select>'
+                f'<select id="ContentPlaceHolder1_ddlYear">{year_options}</select>'
+                "</form></body></html>"
+            )
+            return self.send(200, page.encode(), "text/html")
+
+        form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if form.get("__VIEWSTATE") != self.viewstate():
+            return self.send(500, b"Invalid viewstate", "text/plain")
+        year = form["ctl00$ContentPlaceHolder1$ddlYear"]
+        period = form["ctl00$ContentPlaceHolder1$ddlPeriod"]
+        line = form["ctl00$ContentPlaceHolder1$lbLines"]
+        rng = numpy.random.default_rng(zlib.crc32(f"{year}-{period}-{line}".encode()))
+        boardings = rng.integers(1000, 50000, len(DAY_TYPES))
+        rows = [
+            (day_type, f"{b:,}")
+            for day_type, b in zip(DAY_TYPES + ["Total"], [*boardings, boardings.sum()])
+        ]
+        table = "".join(
+            f"<tr><td>{html.escape(d)}</td><td>{b}</td></tr>" for d, b in rows
+        )
+        page = (
+            f"<html><body><form>{hidden}"
+            f'<table id="{RIDERSHIP_TABLE_ID}">'
+            "<tr><th>Day Type</th><th>Avg. Daily Boardings</th></tr>"
+            f"{table}</table></form></body></html>"
+        )
+        self.send(200, page.encode(), "text/html")
+
+
+def serve(
+    stops=10_000,
+    trips=100_000,
+    lines=20,
+    years=1,
+    latency=0.0,
+    fail_every=0,
+    stop_times=None,
+    trips_csv=None,
+):
+    """
+    Start all three fakes and point the jobs at them through the environment,
+    setting placeholder credentials for any which are not set.
+
+    Returns
+    -------
+    A dict of the servers, keyed by the environment variable set for each.
+    """
+    common = {"latency": latency, "fail_every": fail_every}
+    servers = {
+        "SYNCROMATICS_URL": FakeServer(
+            SyncromaticsHandler, stops=stops, stop_times=stop_times, **common
+        ),
+        "TABLEAU_SERVER": FakeServer(
+            TableauHandler, trips=trips, trips_csv=trips_csv, **common
+        ),
+        "RIDERSHIP_URL": FakeServer(
+            RidershipHandler, lines=lines, years=years, **common
+        ),
+    }
+    # The fakes accept any credentials, but the jobs require some.
+    for name in [
+        "SYNCROMATICS_USERNAME",
+        "SYNCROMATICS_PASSWORD",
+        "BIKESHARE_USERNAME",
+        "BIKESHARE_PASSWORD",
+    ]:
+        os.environ.setdefault(name, "loadtest")
+    os.environ["SYNCROMATICS_URL"] = f"{servers['SYNCROMATICS_URL'].url}/1"
+    os.environ["TABLEAU_SERVER"] = servers["TABLEAU_SERVER"].url
+    ridership = servers["RIDERSHIP_URL"].url
+    os.environ["RIDERSHIP_URL"] = f"{ridership}/MetroRidership/IndexSys.aspx"
+    return servers
+
+
+def add_arguments(parser):
+    """
+    Add the options of the fakes to an argument parser.
+    """
+    parser.add_argument("--stops", type=int, default=10_000, help="DASH stops per day")
+    parser.add_argument(
+        "--trips", type=int, default=100_000, help="Trips in the bikeshare export"
+    )
+    parser.add_argument("--lines", type=int, default=20, help="Metro lines")
+    parser.add_argument("--years", type=int, default=1, help="Years of Metro data")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds of latency per request"
+    )
+    parser.add_argument(
+        "--fail-every",
+        type=int,
+        default=0,
+        help="Answer every nth request to each fake with a 503",
+    )
+    parser.add_argument(
+        "--stop-times", help="A recorded DASH stop times export to replay"
+    )
+    parser.add_argument(
+        "--trips-csv", help="A recorded bikeshare trips view export to replay"
+    )
+
+
+def serve_args(args):
+    """
+    Start the fakes with the options parsed by an argument parser.
+    """
+    return serve(
+        stops=args.stops,
+        trips=args.trips,
+        lines=args.lines,
+        years=args.years,
+        latency=args.latency,
+        fail_every=args.fail_every,
+        stop_times=args.stop_times,
+        trips_csv=args.trips_csv,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the vendor stand-ins")
+    add_arguments(parser)
+    args = parser.parse_args()
+    serve_args(args)
+    for name in ["SYNCROMATICS_URL", "TABLEAU_SERVER", "RIDERSHIP_URL"]:
+        print(f"export {name}={os.environ[name]}")
+    threading.Event().wait()
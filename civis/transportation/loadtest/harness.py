@@ -0,0 +1,160 @@
+"""
+Load test the transportation jobs against local stand-ins for the vendor APIs.
+
+Serves the fakes in fakes.py, then runs the DASH load_pg_data, the bikeshare
+load_pg_data (which reshapes the Tableau export with pivot_measures) and the
+Metro get_all_ridership_data, each in a fresh process, and reports the rows
+per second and peak memory of each.
+
+The DASH and bikeshare jobs load into a scratch "loadtest" schema of the
+database named by POSTGRES_URI, which is dropped and recreated for each run,
+so this must be run in development, e.g.
+
+    DEV=1 POSTGRES_URI=postgresql://postgres@localhost/postgres \\
+        python /app/civis/transportation/loadtest/harness.py --trips 1000000
+"""
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import sys
+import time
+
+import fakes
+
+TRANSPORTATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+LOADTEST_SCHEMA = "loadtest"
+
+# The directory, module and entry point of each job.
+JOBS = {
+    "dash": ("dash", "trips", "load_pg_data"),
+    "bikeshare": ("bikeshare", "trips", "load_pg_data"),
+    "metro": ("metro", "ridership", "get_all_ridership_data"),
+}
+
+
+def import_job(directory, module):
+    """
+    Import a job script by path, under a name which is unique to the job,
+    since several are named trips.py.
+    """
+    path = os.path.join(TRANSPORTATION_DIR, directory, f"{module}.py")
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(f"{directory}_{module}", path)
+    job = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(job)
+    return job
+
+
+def use_scratch_schema(job, schema=LOADTEST_SCHEMA):
+    """
+    Point the tables of a job at an empty scratch schema.
+    """
+    import sqlalchemy
+    from civis_aqueduct_utils.db import get_engine
+
+    metadata = sqlalchemy.MetaData(schema=schema)
+    for name, value in list(vars(job).items()):
+        if isinstance(value, sqlalchemy.Table):
+            setattr(job, name, value.tometadata(metadata, schema=schema))
+    job.metadata = metadata
+    job.SCHEMA = schema
+    metadata.drop_all(get_engine())
+    job.create_table()
+    return metadata
+
+
+def count_rows(metadata):
+    """
+    Count the rows loaded into the tables of a job.
+    """
+    import sqlalchemy
+    from civis_aqueduct_utils.db import get_engine
+
+    with get_engine().connect() as conn:
+        return sum(
+            conn.execute(
+                sqlalchemy.select([sqlalchemy.func.count()]).select_from(t)
+            ).scalar()
+            for t in metadata.sorted_tables
+        )
+
+
+def peak_rss():
+    """
+    The peak resident memory of this process, in bytes. This is read from
+    /proc rather than getrusage, whose maximum survives the exec of a spawned
+    process, and so would include the memory of the harness and the fakes.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+
+def run_job(name, results):
+    """
+    Run a job in this process, putting its rows, time and memory on a queue.
+    """
+    directory, module, function = JOBS[name]
+    job = import_job(directory, module)
+    metadata = use_scratch_schema(job) if hasattr(job, "create_table") else None
+    baseline = peak_rss()
+
+    start = time.perf_counter()
+    result = getattr(job, function)()
+    seconds = time.perf_counter() - start
+
+    rows = len(result) if metadata is None else count_rows(metadata)
+    results.put(
+        {
+            "job": name,
+            "rows": rows,
+            "seconds": seconds,
+            "baseline": baseline,
+            "peak": peak_rss(),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "jobs", nargs="*", help=f"The jobs to run, of {', '.join(JOBS)}, or all"
+    )
+    fakes.add_arguments(parser)
+    args = parser.parse_args()
+    unknown = set(args.jobs) - set(JOBS)
+    if unknown:
+        parser.error(f"Unknown jobs: {', '.join(sorted(unknown))}")
+    if not os.environ.get("DEV"):
+        raise SystemExit("The load test drops tables, so it only runs with DEV set")
+
+    fakes.serve_args(args)
+    # Run each job in a fresh interpreter, so that its memory use is its own.
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    for name in args.jobs or JOBS:
+        print(f"Running {name}")
+        results = context.Queue()
+        process = context.Process(target=run_job, args=(name, results))
+        process.start()
+        process.join()
+        if process.exitcode:
+            raise SystemExit(f"{name} failed with exit code {process.exitcode}")
+        reports.append(results.get())
+
+    print(
+        f"{'job':<10} {'rows':>10} {'seconds':>8} {'rows/s':>10} "
+        f"{'peak MiB':>9} {'imports MiB':>12}"
+    )
+    for r in reports:
+        print(
+            f"{r['job']:<10} {r['rows']:>10} {r['seconds']:>8.2f} "
+            f"{r['rows'] / r['seconds']:>10.0f} {r['peak'] / 2 ** 20:>9.0f} "
+            f"{r['baseline'] / 2 ** 20:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
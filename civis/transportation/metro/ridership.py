@@ -2,16 +2,19 @@
 Scrape Los Angeles Metro ridership data
 """
 import datetime
+import io
 import os
-from urllib.parse import quote_plus
 
 import bs4
 import pandas as pd
-import requests
-import sqlalchemy
+from civis_aqueduct_utils.db import get_engine
+from civis_aqueduct_utils.httpclient import get_session
 
 # The URL for the ridership form
-RIDERSHIP_URL = "http://isotp.metro.net/MetroRidership/IndexSys.aspx"
+RIDERSHIP_URL = (
+    os.environ.get("RIDERSHIP_URL")
+    or "http://isotp.metro.net/MetroRidership/IndexSys.aspx"
+)
 
 # Parameters needed to validate the request
 ASPX_PARAMETERS = ["__VIEWSTATE", "__EVENTVALIDATION"]
@@ -26,7 +29,7 @@ def get_form_data():
     as well as the parameters needed to validate our requests.
     """
     # Fetch the page and parse it
-    r = requests.get(RIDERSHIP_URL)
+    r = get_session().get(RIDERSHIP_URL)
     r.raise_for_status()
     soup = bs4.BeautifulSoup(r.text, features="html.parser")
 
@@ -82,7 +85,8 @@ def submit_form(year, period, line, aspx_data):
         "ctl00$ContentPlaceHolder1$lbLines": str(line),
         **aspx_data,
     }
-    r = requests.post(RIDERSHIP_URL, data=form_data)
+    # The form only queries the data, so it is safe to submit again.
+    r = get_session().post(RIDERSHIP_URL, data=form_data, retry=True)
     r.raise_for_status()
     if r.text.find("Data not available yet") != -1:
         raise ValueError(f"Data not available for {year}, {period}, {line}")
@@ -104,7 +108,7 @@ def parse_response(html):
     A dataframe from the parsed HTML table.
     """
     tables = pd.read_html(
-        html,
+        io.StringIO(html),
         flavor="bs4",
         attrs={"id": "ContentPlaceHolder1_ASPxRoundPanel2_gvRidership"},
     )
@@ -149,7 +153,7 @@ def get_all_ridership_data(verbosity=0):
     """
     lines, years, aspx_data = get_form_data()
     months = [str(i) for i in range(1, 13)]
-    ridership = pd.DataFrame()
+    frames = []
     # Get the current timestamp so we don't try to fetch from the future.
     now = pd.Timestamp.now()
 
@@ -168,14 +172,18 @@ def get_all_ridership_data(verbosity=0):
             for line in lines:
                 try:
                     df = get_ridership_data(year, month, line, aspx_data)
-                    ridership = ridership.append(df)
+                    frames.append(df)
                     if verbosity > 2:
                         print(f"Fetched data for line {line}")
                 except Exception as e:
                     if verbosity > 2:
                         print(f"Failed to get data for line {line}")
                         print(e)
-    return ridership
+    if verbosity > 0:
+        print(get_session().metrics.summary())
+    # Concatenate once at the end, rather than copying the accumulated
+    # data for every line.
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
 
 if __name__ == "__main__":
@@ -188,20 +196,9 @@ if __name__ == "__main__":
     ridership = get_all_ridership_data(2)
 
     # Load into the data warehouse
-    if os.environ.get("DEV"):
-        POSTGRES_URI = os.environ.get("POSTGRES_URI")
-    else:
-        POSTGRES_URI = (
-            f"postgres://"
-            f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_USERNAME'])}:"
-            f"{quote_plus(os.environ['POSTGRES_CREDENTIAL_PASSWORD'])}@"
-            f"{os.environ['POSTGRES_HOST']}:{os.environ['POSTGRES_PORT']}"
-            f"/{os.environ['POSTGRES_DATABASE']}"
-        )
-    engine = sqlalchemy.create_engine(POSTGRES_URI)
     ridership.to_sql(
         "metro_ridership",
-        engine,
+        get_engine(),
         schema="transportation",
         if_exists="replace",
         index=False,